@@ -0,0 +1,84 @@
+"""Micro-benchmark of the HTML extraction paths against saved page fixtures.
+
+Run from the repository root:
+
+    python benchmarks/bench_extract.py [iterations]
+
+The "old" rows are the full BeautifulSoup(..., 'html.parser') parses that
+natrail.py used before extract.py, the other rows are the extract.py backends.
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+
+import extract
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def old_disruptions(page):
+    soup = BeautifulSoup(page, 'html.parser')
+    disruptions = []
+    for disruption in soup.find_all('li', class_='styled__StyledNotificationListItem-sc-nisfz3-3'):
+        link = disruption.find('a', class_='styled__StyledNotificationBox-sc-2fuu9j-2')
+        if link:
+            disruptions.append((link.get('aria-label', 'No description available').strip(), link.get('href', '#').strip()))
+    return disruptions
+
+
+def old_operator_slug(page):
+    soup = BeautifulSoup(page, 'html.parser')
+    links = [link['href'] for link in soup.find_all('a', href=True) if '/travel-information/operators/' in link['href']]
+    if links:
+        return links[0].replace('/travel-information/operators/', '').replace('/', '')
+    return None
+
+
+def measure(func, page, iterations):
+    # Timing and peak memory are taken in separate runs, tracemalloc slows parsing down
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = func(page)
+    elapsed = (time.perf_counter() - start) / iterations
+
+    tracemalloc.start()
+    func(page)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    cases = [
+        ('status-and-disruptions.html', [('old', old_disruptions)] + [
+            (name, funcs[0]) for name, funcs in extract.BACKENDS.items()
+        ]),
+        ('service-disruption.html', [('old', old_operator_slug)] + [
+            (name, funcs[1]) for name, funcs in extract.BACKENDS.items()
+        ]),
+    ]
+
+    print(f"{'fixture':<28} {'path':<8} {'ms/parse':>10} {'peak KiB':>10}")
+    for fixture, paths in cases:
+        with open(os.path.join(FIXTURES, fixture), encoding='utf-8') as f:
+            page = f.read()
+
+        expected = None
+        for name, func in paths:
+            result, elapsed, peak = measure(func, page, iterations)
+            if expected is None:
+                expected = result
+            elif result != expected:
+                print(f"{fixture}: {name} returned a different result from the old path")
+            print(f"{fixture:<28} {name:<8} {elapsed * 1000:>10.2f} {peak / 1024:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Benchmark of the facet builder against the old per-post regex functions.
+
+Run from the repository root:
+
+    python benchmarks/bench_facets.py [iterations]
+
+The "old" row is modify_string + extract_url_byte_positions +
+extract_hashtag_byte_positions as natrail.py used them before facets.py.
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from facets import FacetBuilder
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def modify_string(text):
+    text = re.sub(r'(between[^A-Z]*)([A-Z])', r'\1#\2', text)
+    text = re.sub(r'(and[^A-Z]*)([A-Z])', r'\1#\2', text)
+    text = re.sub(r'(from[^A-Z]*)([A-Z])', r'\1#\2', text)
+    text = re.sub(r'\b(Northern|Merseyrail)\b', r'#\1', text)
+    return text
+
+
+def extract_hashtag_byte_positions(text, *, encoding='UTF-8'):
+    encoded_text = text.encode(encoding)
+    return [(m.group(0).decode(encoding), m.start(), m.end()) for m in re.finditer(rb'#\w+', encoded_text)]
+
+
+def extract_url_byte_positions(text, *, encoding='UTF-8'):
+    encoded_text = text.encode(encoding)
+    return [(m.group(0).decode(encoding), m.start(), m.end()) for m in re.finditer(rb'https?://[^ \n\r\t]*', encoded_text)]
+
+
+def old_build(text):
+    message = f"{modify_string(text)}\n"
+    return message, extract_url_byte_positions(message) + extract_hashtag_byte_positions(message)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with open(os.path.join(FIXTURES, 'disruption_texts.txt'), encoding='utf-8') as f:
+        corpus = [line.strip() for line in f if line.strip()]
+
+    start = time.perf_counter()
+    builder = FacetBuilder()
+    print(f"gazetteer index built in {(time.perf_counter() - start) * 1000:.1f} ms, {len(builder.tags)} names")
+
+    new_build = builder.build
+    for name, build in (('old', old_build), ('new', new_build)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for text in corpus:
+                build(text)
+        elapsed = (time.perf_counter() - start) / (iterations * len(corpus))
+        tags = sum(len(build(text)[1]) for text in corpus)
+        print(f"{name:<4} {elapsed * 1e6:>8.1f} us/text {tags:>5} facets on {len(corpus)} texts")
+
+    # Links must cover their URL and tags must start at the inserted '#'
+    for text in corpus:
+        message, facets = new_build(text)
+        encoded = message.encode('utf-8')
+        for kind, value, byte_start, byte_end in facets:
+            span = encoded[byte_start:byte_end].decode('utf-8')
+            assert span == value if kind == 'link' else span.startswith('#'), (span, value)
+
+    print("\nsample:")
+    for name, build in (('old', old_build), ('new', new_build)):
+        message, facets = build(corpus[2])
+        print(f"{name}: {message.strip()}")
+
+
+if __name__ == '__main__':
+    main()
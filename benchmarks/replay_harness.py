@@ -0,0 +1,296 @@
+"""Offline replay harness and end-to-end cycle benchmark.
+
+Serves the recorded National Rail fixtures, a Flickr REST stand-in and an
+atproto PDS stand-in from one local HTTP server, points natrail.py at it
+with BASE_URL_OVERRIDES, and times one full cycle (fetch_disruptions ->
+outbox enrichment -> post, including retries) per run.
+
+Run from the repository root:
+
+    python benchmarks/replay_harness.py [--sizes 1,50,500] [--latency 0.02] [--rate-limit-every 25] [--fan-out]
+
+--fan-out delivers every post to two Bluesky accounts, a Mastodon stand-in and
+a webhook instead of the single default account.
+
+Each size and posting mode runs in a fresh subprocess with its own working
+directory, so the database, caches and peak RSS start clean every time.
+Use --json to save the results for comparing against a later change.
+"""
+import argparse
+import base64
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+
+_ITEM_PATTERN = re.compile(r'<li class="styled__StyledNotificationListItem.*?</li>', re.DOTALL)
+_HREF_PATTERN = re.compile(r'href="/service-disruptions/[^"]*"')
+
+# Any valid CID will do, the stand-in never checks blob contents
+_BLOB_CID = 'bafkreibme22gw2h7y2h7tg2fhqotaqjucnbc24deqo72b6mkl2egezxhvy'
+_DID = 'did:plc:replayharness0000000000'
+
+
+def _read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def status_page(size):
+    """The recorded status page with its disruption list resized to `size` items."""
+    page = _read_fixture('status-and-disruptions.html')
+    items = _ITEM_PATTERN.findall(page)
+    generated = []
+    for i in range(size):
+        item = items[i % len(items)]
+        generated.append(_HREF_PATTERN.sub(f'href="/service-disruptions/replay-{i}/"', item))
+    start = page.index(items[0])
+    end = page.index(items[-1]) + len(items[-1])
+    return page[:start] + '\n'.join(generated) + page[end:]
+
+
+def stand_in_photo():
+    """A full-size noisy JPEG like a Flickr original, or random bytes without Pillow."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return os.urandom(48 * 1024)
+    import io
+    out = io.BytesIO()
+    Image.frombytes('RGB', (1600, 1200), os.urandom(1600 * 1200 * 3)).save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def _jwt(expires_in):
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+    payload = {'sub': _DID, 'scope': 'com.atproto.access', 'iat': int(time.time()), 'exp': int(time.time()) + expires_in}
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode(payload)}.c2lnbmF0dXJl"
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, size, latency, rate_limit_every):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.status_page = status_page(size).encode('utf-8')
+        self.detail_page = _read_fixture('service-disruption.html').encode('utf-8')
+        self.image = stand_in_photo()
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.posts = 0
+        self.records = {}
+        self.statuses = {}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return self.counts[name]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, method):
+        server = self.server
+        time.sleep(server.latency)
+        parts = urlsplit(self.path)
+        path = parts.path
+        body = b''
+        if method == 'POST':
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        if path.startswith('/status-and-disruptions'):
+            server.count('national_rail_list')
+            return self._send(200, server.status_page, 'text/html; charset=utf-8')
+        if path.startswith('/service-disruptions/'):
+            server.count('national_rail_detail')
+            return self._send(200, server.detail_page, 'text/html; charset=utf-8')
+        if path == '/services/rest/':
+            server.count('flickr_search')
+            query = parse_qs(parts.query)
+            seed = abs(hash(query.get('text', [''])[0])) % 1000
+            photos = [{'id': f'{seed}{i}', 'server': '65535', 'secret': 'replay'} for i in range(10)]
+            return self._send(200, {'photos': {'photo': photos}, 'stat': 'ok'})
+        if path.endswith('.jpg'):
+            server.count('flickr_image')
+            return self._send(200, server.image, 'image/jpeg')
+
+        if path == '/xrpc/com.atproto.server.createSession':
+            server.count('login')
+            return self._send(200, {'accessJwt': _jwt(3600), 'refreshJwt': _jwt(86400), 'handle': 'replay.test', 'did': _DID})
+        if path == '/xrpc/com.atproto.server.refreshSession':
+            server.count('refresh')
+            return self._send(200, {'accessJwt': _jwt(3600), 'refreshJwt': _jwt(86400), 'handle': 'replay.test', 'did': _DID})
+        if path == '/xrpc/app.bsky.actor.getProfile':
+            server.count('get_profile')
+            return self._send(200, {'did': _DID, 'handle': 'replay.test'})
+        if path == '/xrpc/com.atproto.repo.uploadBlob':
+            server.count('upload_blob')
+            return self._send(200, {'blob': {'$type': 'blob', 'ref': {'$link': _BLOB_CID}, 'mimeType': 'image/jpeg', 'size': len(server.image)}})
+        if path == '/xrpc/com.atproto.repo.createRecord':
+            attempt = server.count('create_record')
+            if server.rate_limit_every and attempt % server.rate_limit_every == 0:
+                server.count('rate_limited')
+                return self._send(429, {'error': 'RateLimitExceeded', 'message': 'Rate Limit Exceeded'},
+                                  headers={'Retry-After': '1', 'ratelimit-remaining': '0'})
+            with server.lock:
+                server.posts += 1
+                rkey = json.loads(body).get('rkey') or str(server.posts)
+                if rkey in server.records:
+                    return self._send(400, {'error': 'InvalidRequest', 'message': 'Record already exists'})
+                server.records[rkey] = f'at://{_DID}/app.bsky.feed.post/{rkey}'
+            return self._send(200, {'uri': server.records[rkey], 'cid': _BLOB_CID})
+        if path == '/xrpc/com.atproto.repo.getRecord':
+            server.count('get_record')
+            uri = server.records.get(parse_qs(parts.query).get('rkey', [''])[0])
+            if uri is None:
+                return self._send(400, {'error': 'RecordNotFound', 'message': 'Could not locate record'})
+            return self._send(200, {'uri': uri, 'cid': _BLOB_CID, 'value': {'$type': 'app.bsky.feed.post', 'text': '', 'createdAt': '2024-01-01T00:00:00Z'}})
+
+        if path == '/api/v1/statuses':
+            server.count('mastodon_status')
+            with server.lock:
+                # Repeats of an Idempotency-Key get the status created the first time
+                key = self.headers.get('Idempotency-Key') or str(len(server.statuses))
+                status_id = server.statuses.setdefault(key, str(len(server.statuses) + 1))
+            return self._send(200, {'id': status_id, 'url': f'https://masto.test/@replay/{status_id}'})
+        if path == '/webhook':
+            server.count('webhook')
+            return self._send(200, {'ok': True})
+
+        server.count('not_found')
+        return self._send(404, {'error': 'NotFound', 'message': path})
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+
+# Sinks used by --fan-out, every host is sent to the stand-in by BASE_URL_OVERRIDES
+FAN_OUT_SINKS = [
+    {'type': 'bluesky', 'name': 'bluesky', 'handle': 'replay.test', 'password': 'replay'},
+    {'type': 'bluesky', 'name': 'bluesky-second', 'handle': 'second.replay.test', 'password': 'replay'},
+    {'type': 'mastodon', 'name': 'mastodon', 'base_url': 'https://masto.test', 'token': 'replay'},
+    {'type': 'webhook', 'name': 'webhook', 'url': 'https://hooks.test/webhook'},
+]
+
+
+def run_cycle(size, latency, rate_limit_every, concurrent, fan_out=False):
+    """Child process: start the stand-in, run one natrail cycle and report as JSON."""
+    server = StandInServer(size, latency, rate_limit_every)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    workdir = tempfile.mkdtemp(prefix='natrail-replay-')
+    os.chdir(workdir)
+    if fan_out:
+        with open('sinks.json', 'w') as f:
+            json.dump(FAN_OUT_SINKS, f)
+    os.environ.update({
+        'BASE_URL_OVERRIDES': f'http://127.0.0.1:{server.server_address[1]}',
+        'BLUESKY_HANDLE': 'replay.test',
+        'BLUESKY_PASSWORD': 'replay',
+        'FLICKR_API_KEY': 'replay',
+        'POSTS_PER_MINUTE': '100000',
+        'POST_BURST': '1000',
+        'POST_DELAY_SECONDS': '0',
+        'CONCURRENT_POSTING': '1' if concurrent else '0',
+    })
+    sys.path.insert(0, ROOT)
+
+    import logging
+    import natrail
+    natrail.init()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    natrail.fetch_disruptions(natrail.random_user_agent)
+    unposted = natrail.store.get_unposted_disruptions()
+    natrail.post_pending()
+    # Rate-limited posts are retried from the outbox once their retry time comes
+    while natrail.store.next_outbox_retry() is not None:
+        time.sleep(max(natrail.store.next_outbox_retry() - time.time(), 0))
+        natrail.post_pending()
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'size': size,
+        'mode': 'concurrent' if concurrent else 'sequential',
+        'seconds': round(elapsed, 3),
+        'posted': len(unposted) - len(natrail.store.get_unposted_disruptions()),
+        'sent': sum(count for (sink, state), count in natrail.store.delivery_counts().items() if state == 'sent'),
+        'requests': sum(server.counts.values()),
+        'requests_by_endpoint': server.counts,
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1,50,500', help='comma separated disruption counts')
+    parser.add_argument('--modes', default='sequential,concurrent', help='posting modes to run')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every stand-in response')
+    parser.add_argument('--rate-limit-every', type=int, default=25, help='answer every Nth post with a 429, 0 for never')
+    parser.add_argument('--fan-out', action='store_true', help='deliver to four sinks instead of one Bluesky account')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--concurrent', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_cycle(args.size, args.latency, args.rate_limit_every, args.concurrent, args.fan_out)
+        return
+
+    results = []
+    print(f"{'size':>5} {'mode':<11} {'seconds':>9} {'posted':>7} {'sent':>6} {'requests':>9} {'429s':>5} {'peak RSS MiB':>13}")
+    for size in (int(size) for size in args.sizes.split(',')):
+        for mode in args.modes.split(','):
+            command = [sys.executable, os.path.abspath(__file__), '--child', '--size', str(size),
+                       '--latency', str(args.latency), '--rate-limit-every', str(args.rate_limit_every)]
+            if mode == 'concurrent':
+                command.append('--concurrent')
+            if args.fan_out:
+                command.append('--fan-out')
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{size:>5} {mode:<11} {result['seconds']:>9.2f} {result['posted']:>7} {result['sent']:>6} {result['requests']:>9} "
+                  f"{result['requests_by_endpoint'].get('rate_limited', 0):>5} {result['peak_rss_kib'] / 1024:>13.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
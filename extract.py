@@ -0,0 +1,113 @@
+import html
+import os
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Class names on the National Rail pages are styled-components names with a
+# hashed suffix (styled__StyledNotificationBox-sc-2fuu9j-2) that changes on
+# every site build, so nodes are matched on the stable prefix only.
+DISRUPTION_ITEM_CLASS = 'styled__StyledNotificationListItem-'
+DISRUPTION_LINK_CLASS = 'styled__StyledNotificationBox-'
+OPERATOR_PATH = '/travel-information/operators/'
+
+# Opening <a> tags, allowing '>' inside quoted attribute values
+_A_TAG_PATTERN = re.compile(r'<a\s((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>', re.IGNORECASE)
+_ATTR_PATTERN = re.compile(r'([\w:.-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+_OPERATOR_HREF_PATTERN = re.compile(r'href\s*=\s*["\']([^"\']*' + re.escape(OPERATOR_PATH) + r'[^"\']*)["\']', re.IGNORECASE)
+
+
+def _parse_attrs(attr_text: str) -> Dict[str, str]:
+    attrs = {}
+    for match in _ATTR_PATTERN.finditer(attr_text):
+        name = match.group(1).lower()
+        value = next((group for group in match.groups()[1:] if group is not None), '')
+        attrs[name] = html.unescape(value)
+    return attrs
+
+
+def _has_class_prefix(class_value: str, prefix: str) -> bool:
+    return any(name.startswith(prefix) for name in class_value.split())
+
+
+def _operator_slug(href: str) -> str:
+    return href.replace(OPERATOR_PATH, '').replace('/', '')
+
+
+def _disruption_tuple(aria_label: Optional[str], href: Optional[str]) -> Tuple[str, str]:
+    return (aria_label or 'No description available').strip(), (href or '#').strip()
+
+
+# Regex backend: scans opening <a> tags only and never builds a tree.
+
+def _scan_disruptions(page: str) -> List[Tuple[str, str]]:
+    disruptions = []
+    for match in _A_TAG_PATTERN.finditer(page):
+        tag = match.group(1)
+        if DISRUPTION_LINK_CLASS not in tag:
+            continue
+        attrs = _parse_attrs(tag)
+        if _has_class_prefix(attrs.get('class', ''), DISRUPTION_LINK_CLASS):
+            disruptions.append(_disruption_tuple(attrs.get('aria-label'), attrs.get('href')))
+    return disruptions
+
+
+def _scan_operator_slug(page: str) -> Optional[str]:
+    match = _OPERATOR_HREF_PATTERN.search(page)
+    if match:
+        return _operator_slug(html.unescape(match.group(1)))
+    return None
+
+
+# Soup backend: BeautifulSoup restricted by a SoupStrainer, using lxml when installed.
+
+def _soup_parser() -> str:
+    try:
+        import lxml  # noqa: F401
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+
+def _soup_disruptions(page: str) -> List[Tuple[str, str]]:
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    is_item = lambda value: value is not None and _has_class_prefix(value, DISRUPTION_ITEM_CLASS)
+    is_link = lambda value: value is not None and _has_class_prefix(value, DISRUPTION_LINK_CLASS)
+    soup = BeautifulSoup(page, _soup_parser(), parse_only=SoupStrainer('li', class_=is_item))
+
+    disruptions = []
+    for item in soup.find_all('li', class_=is_item):
+        link = item.find('a', class_=is_link)
+        if link:
+            disruptions.append(_disruption_tuple(link.get('aria-label'), link.get('href')))
+    return disruptions
+
+
+def _soup_operator_slug(page: str) -> Optional[str]:
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    is_operator = lambda value: value is not None and OPERATOR_PATH in value
+    soup = BeautifulSoup(page, _soup_parser(), parse_only=SoupStrainer('a', href=is_operator))
+    link = soup.find('a', href=is_operator)
+    if link:
+        return _operator_slug(link['href'])
+    return None
+
+
+BACKENDS: Dict[str, Tuple[Callable[[str], List[Tuple[str, str]]], Callable[[str], Optional[str]]]] = {
+    'regex': (_scan_disruptions, _scan_operator_slug),
+    'soup': (_soup_disruptions, _soup_operator_slug),
+}
+
+# Backend used when none is passed, override with EXTRACT_BACKEND=soup
+DEFAULT_BACKEND = os.getenv('EXTRACT_BACKEND', 'regex')
+
+
+def extract_disruptions(page: str, backend: Optional[str] = None) -> List[Tuple[str, str]]:
+    """Return (aria-label, href) for every disruption on the status page."""
+    return BACKENDS[backend or DEFAULT_BACKEND][0](page)
+
+
+def extract_operator_slug(page: str, backend: Optional[str] = None) -> Optional[str]:
+    """Return the first operator slug linked from a disruption detail page."""
+    return BACKENDS[backend or DEFAULT_BACKEND][1](page)
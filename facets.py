@@ -0,0 +1,100 @@
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Station and operator names to hashtag, one "kind<TAB>name[<TAB>tag]" per line
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.tsv')
+
+# Facets are (kind, value, byte_start, byte_end) with kind 'link' or 'tag'
+Facet = Tuple[str, str, int, int]
+
+_URL_PATTERN = rb'https?://[^ \n\r\t]*'
+_HASHTAG_PATTERN = rb'#\w+'
+
+
+def load_gazetteer(path: str = GAZETTEER_PATH) -> Dict[str, str]:
+    """Return {name: tag} for every station and operator in the gazetteer file."""
+    names = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            name = fields[1].strip()
+            tag = fields[2].strip() if len(fields) > 2 and fields[2].strip() else re.sub(r'\W', '', name)
+            names[name] = tag
+    return names
+
+
+def _trie_pattern(names: Iterable[bytes]) -> bytes:
+    """Compile names into a regex shaped like their prefix trie.
+
+    Alternatives are grouped by shared prefix so the regex engine walks each
+    prefix once, and optional tails are greedy so the longest name wins
+    (Liverpool Lime Street before Liverpool).
+    """
+    trie: dict = {}
+    for name in names:
+        node = trie
+        for byte in name:
+            node = node.setdefault(byte, {})
+        node[None] = True
+
+    def render(node: dict) -> bytes:
+        terminal = None in node
+        branches = [re.escape(bytes([byte])) + render(node[byte]) for byte in sorted(key for key in node if key is not None)]
+        if not branches:
+            return b''
+        body = branches[0] if len(branches) == 1 else b'(?:' + b'|'.join(branches) + b')'
+        if terminal:
+            return b'(?:' + body + b')?'
+        return body
+
+    return render(trie)
+
+
+class FacetBuilder:
+    """Single-pass hashtag and link detection over the UTF-8 bytes of a message.
+
+    One compiled pattern matches URLs, existing #hashtags and gazetteer names
+    in a single scan. Gazetteer names get a '#' inserted in front of them and a
+    tag facet covering the whole name, so multi-word stations stay readable.
+    """
+
+    def __init__(self, names: Optional[Dict[str, str]] = None):
+        if names is None:
+            names = load_gazetteer()
+        self.tags = {name.encode('utf-8'): tag for name, tag in names.items()}
+        self.pattern = re.compile(
+            b'(?P<url>' + _URL_PATTERN + b')'
+            b'|(?P<hashtag>' + _HASHTAG_PATTERN + b')'
+            b'|(?<![\\w#])(?P<name>' + _trie_pattern(self.tags) + b')(?!\\w)'
+        )
+
+    def build(self, text: str) -> Tuple[str, List[Facet]]:
+        """Return the message with hashtags added and its facets in byte offsets."""
+        encoded = text.encode('utf-8')
+        out = bytearray()
+        facets = []
+        position = 0
+
+        for match in self.pattern.finditer(encoded):
+            out += encoded[position:match.start()]
+            position = match.end()
+            start = len(out)
+            kind = match.lastgroup
+            value = match.group()
+
+            if kind == 'url':
+                out += value
+                facets.append(('link', value.decode('utf-8'), start, len(out)))
+            elif kind == 'hashtag':
+                out += value
+                facets.append(('tag', value[1:].decode('utf-8'), start, len(out)))
+            else:
+                out += b'#' + value
+                facets.append(('tag', self.tags[value], start, len(out)))
+
+        out += encoded[position:]
+        return out.decode('utf-8'), facets
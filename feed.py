@@ -0,0 +1,191 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape, quoteattr
+
+from store import DisruptionStore
+
+logger = logging.getLogger(__name__)
+
+
+# Paths the feed is served on, and the content type of each
+FORMATS = {
+    '/disruptions.json': ('json', 'application/json; charset=utf-8'),
+    '/disruptions.atom': ('atom', 'application/atom+xml; charset=utf-8'),
+}
+
+FEED_TITLE = 'National Rail disruptions'
+
+# A response: body, ETag and content type
+Rendered = Tuple[bytes, str, str]
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class DisruptionFeed:
+    """The active disruptions as JSON and Atom, rendered once per change.
+
+    invalidate() is called when a scrape changes the active set. Until then
+    every response, including each operator filter, comes from memory with
+    an ETag and Last-Modified, so clients that poll often get a 304 for the
+    cost of comparing two strings.
+    """
+
+    def __init__(self, store: DisruptionStore):
+        self.store = store
+        self.lock = threading.Lock()
+        # Bumped by every invalidate(), so a render that raced one is not kept
+        self.version = 0
+        self.changed_at = time.time()
+        self.rows: Optional[List[Dict[str, Any]]] = None
+        self.rendered: Dict[Tuple[str, Optional[str]], Rendered] = {}
+        self.stats = {'responses': 0, 'not_modified': 0, 'renders': 0}
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.changed_at = time.time()
+            self.rows = None
+            self.rendered = {}
+
+    def _snapshot(self) -> Tuple[int, List[Dict[str, Any]]]:
+        with self.lock:
+            if self.rows is not None:
+                return self.version, self.rows
+            version = self.version
+        rows = self.store.get_active_disruptions()
+        with self.lock:
+            if version == self.version:
+                self.rows = rows
+        return version, rows
+
+    def get(self, fmt: str, operator: Optional[str] = None) -> Tuple[Rendered, float]:
+        """Return the rendered feed in fmt ('json' or 'atom') for one operator slug or all, and when it last changed."""
+        key = (fmt, operator.lower() if operator else None)
+        with self.lock:
+            rendered = self.rendered.get(key)
+            if rendered is not None:
+                return rendered, self.changed_at
+
+        version, rows = self._snapshot()
+        if key[1]:
+            rows = [row for row in rows if (row['operator'] or '').lower() == key[1]]
+        with self.lock:
+            changed_at = self.changed_at
+        body = self._render_json(rows, changed_at) if fmt == 'json' else self._render_atom(rows, changed_at, key[1])
+        rendered = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"', FORMATS[f'/disruptions.{fmt}'][1])
+        with self.lock:
+            self.stats['renders'] += 1
+            if version == self.version:
+                self.rendered[key] = rendered
+        return rendered, changed_at
+
+    @staticmethod
+    def _render_json(rows: List[Dict[str, Any]], changed_at: float) -> bytes:
+        return json.dumps({
+            'updated': _iso(changed_at),
+            'count': len(rows),
+            'disruptions': [{
+                'link': row['link'],
+                'description': row['disruption'],
+                'operator': row['operator'],
+                'first_seen': row['date'],
+                'updated': _iso(row['updated_ts']) if row['updated_ts'] else None,
+            } for row in rows],
+        }).encode('utf-8')
+
+    @staticmethod
+    def _render_atom(rows: List[Dict[str, Any]], changed_at: float, operator: Optional[str]) -> bytes:
+        feed_id = 'urn:natrail:disruptions' + (f':{operator}' if operator else '')
+        parts = [
+            '<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">',
+            f'<title>{escape(FEED_TITLE + (f" ({operator})" if operator else ""))}</title>',
+            f'<id>{escape(feed_id)}</id>',
+            f'<updated>{_iso(changed_at)}</updated>',
+            '<link rel="via" href="https://www.nationalrail.co.uk/status-and-disruptions/"/>',
+            '<author><name>natrail-bot</name></author>',
+        ]
+        for row in rows:
+            entry = [
+                '<entry>',
+                f'<title>{escape(row["disruption"])}</title>',
+                f'<id>{escape(row["link"])}</id>',
+                f'<link href={quoteattr(row["link"])}/>',
+                f'<updated>{_iso(row["updated_ts"] or changed_at)}</updated>',
+            ]
+            if row['operator']:
+                entry.append(f'<category term={quoteattr(row["operator"])}/>')
+            entry.append(f'<summary>{escape(row["disruption"])}</summary>')
+            entry.append('</entry>')
+            parts.append(''.join(entry))
+        parts.append('</feed>\n')
+        return '\n'.join(parts).encode('utf-8')
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """Serve /disruptions.json and /disruptions.atom, both taking ?operator=<slug>, from a background thread."""
+        feed = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so a client polling often does not reconnect every time
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _not_modified(self, etag: str, last_modified: float) -> bool:
+                if_none_match = self.headers.get('If-None-Match')
+                if if_none_match:
+                    return etag in (tag.strip() for tag in if_none_match.split(',')) or if_none_match.strip() == '*'
+                if_modified_since = self.headers.get('If-Modified-Since')
+                if if_modified_since:
+                    try:
+                        return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+                    except (TypeError, ValueError):
+                        return False
+                return False
+
+            def _respond(self, head_only: bool):
+                parts = urlsplit(self.path)
+                if parts.path not in FORMATS:
+                    self.send_error(404)
+                    return
+                operator = parse_qs(parts.query).get('operator', [None])[0]
+                (body, etag, content_type), changed_at = feed.get(FORMATS[parts.path][0], operator)
+
+                if self._not_modified(etag, changed_at):
+                    feed.stats['not_modified'] += 1
+                    self.send_response(304)
+                    body = b''
+                else:
+                    feed.stats['responses'] += 1
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', formatdate(int(changed_at), usegmt=True))
+                # Clients may keep the response but should check back with the validators
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                if body and not head_only:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                self._respond(head_only=False)
+
+            def do_HEAD(self):
+                self._respond(head_only=True)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='feed-http', daemon=True).start()
+        logger.info(f"Serving the disruption feed on http://{host}:{server.server_address[1]}/disruptions.json and .atom")
+        return server
@@ -0,0 +1,126 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+# Connect and read timeouts in seconds, so a hung server cannot stall a cycle
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 30.0
+
+
+def parse_overrides(spec: str) -> Dict[str, str]:
+    """Parse 'https://host=http://127.0.0.1:8001,...' into {origin: base URL}.
+
+    A single URL without '=' sends every host to that one server.
+    """
+    overrides = {}
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        if '=' in part:
+            origin, base = part.split('=', 1)
+            overrides[origin.rstrip('/')] = base.rstrip('/')
+        else:
+            overrides['*'] = part.rstrip('/')
+    return overrides
+
+
+def _has_h2() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class HttpClient:
+    """Shared pooled HTTP client that every outgoing fetch goes through.
+
+    Connections are kept alive and pooled per host by httpx, every request
+    has connect/read timeouts and is timed per host, and URLs can be
+    redirected to a local stand-in server with base URL overrides.
+    """
+
+    def __init__(self, overrides: Optional[Dict[str, str]] = None, connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT, http2: bool = False, verify: bool = True):
+        self.overrides = overrides or {}
+        http2 = http2 and _has_h2()
+        self.client = httpx.Client(
+            http2=http2,
+            verify=verify,
+            follow_redirects=True,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+        )
+        self.lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, float]] = {}
+        logger.info(f"HTTP client ready (HTTP/2 {'on' if http2 else 'off'}, timeouts {connect_timeout}s connect / {read_timeout}s read, overrides {self.overrides or 'none'})")
+
+    def rewrite(self, url: str) -> str:
+        """Apply any base URL override to a URL, keeping its path and query."""
+        if not self.overrides:
+            return url
+        parts = urlsplit(url)
+        base = self.overrides.get(f"{parts.scheme}://{parts.netloc}", self.overrides.get('*'))
+        if base is None:
+            return url
+        base_parts = urlsplit(base)
+        return urlunsplit((base_parts.scheme, base_parts.netloc, base_parts.path + parts.path, parts.query, parts.fragment))
+
+    def _record(self, host: str, elapsed: float, error: bool):
+        with self.lock:
+            stats = self.stats.setdefault(host, {'requests': 0, 'errors': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['errors'] += error
+            stats['seconds'] += elapsed
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        url = self.rewrite(url)
+        host = urlsplit(url).netloc
+        start = time.perf_counter()
+        try:
+            response = self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self._record(host, time.perf_counter() - start, True)
+            raise
+        elapsed = time.perf_counter() - start
+        self._record(host, elapsed, response.status_code >= 500)
+        logger.debug("%s %s %s %s in %.3fs", method, url, response.status_code, response.http_version, elapsed)
+        return response
+
+    def get(self, url: str, **kwargs) -> httpx.Response:
+        return self.request('GET', url, **kwargs)
+
+    @contextmanager
+    def stream(self, method: str, url: str, **kwargs) -> Iterator[httpx.Response]:
+        """Like request(), but the body is read by the caller, timed until the block exits."""
+        url = self.rewrite(url)
+        host = urlsplit(url).netloc
+        start = time.perf_counter()
+        error = True
+        try:
+            with self.client.stream(method, url, **kwargs) as response:
+                yield response
+                error = response.status_code >= 500
+        finally:
+            self._record(host, time.perf_counter() - start, error)
+
+    def close(self):
+        self.client.close()
+
+
+def client_from_env() -> HttpClient:
+    """Build the client from environment variables."""
+    return HttpClient(
+        overrides=parse_overrides(os.getenv('BASE_URL_OVERRIDES', '')),
+        connect_timeout=float(os.getenv('HTTP_CONNECT_TIMEOUT', str(CONNECT_TIMEOUT))),
+        read_timeout=float(os.getenv('HTTP_READ_TIMEOUT', str(READ_TIMEOUT))),
+        http2=os.getenv('HTTP2', '0') == '1',
+        verify=os.getenv('HTTP_VERIFY', '1') != '0',
+    )
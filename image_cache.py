@@ -0,0 +1,191 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Default location of the image cache and how long Flickr results are trusted
+CACHE_DIR = 'image_cache'
+CANDIDATE_TTL = 6 * 60 * 60
+
+# Thumbnails not used and rejections not retried for this many days are pruned by maintenance
+IMAGE_CACHE_DAYS = 7
+
+
+class ImageCache:
+    """Operator photo candidates in memory, thumbnail bytes and blob refs on disk.
+
+    Thumbnails are stored content-addressed under their SHA-256, with an
+    index mapping each source URL to its digest and each digest and account
+    to the BlobRef (as JSON) it was uploaded as. Source URLs that could not be
+    turned into a thumbnail are remembered so they are not tried again.
+    A thumbnail's modification time is its last use, which prune() goes by.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, ttl: int = CANDIDATE_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.candidates: Dict[str, tuple] = {}
+        # Held around a candidate miss and the search that fills it, one per operator
+        self.operator_locks: Dict[str, threading.Lock] = {}
+        self.stats = {
+            'candidate_hits': 0, 'candidate_misses': 0,
+            'image_hits': 0, 'image_misses': 0,
+            'blob_hits': 0, 'blob_misses': 0,
+        }
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.index = {'urls': {}, 'blobs': {}, 'rejected': {}}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    self.index.update(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable image cache index: {e}")
+
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def operator_lock(self, operator: str) -> threading.Lock:
+        """Return the lock that lets one worker search for an operator while the others wait."""
+        with self.lock:
+            return self.operator_locks.setdefault(operator, threading.Lock())
+
+    def next_candidate(self, operator: str) -> Optional[str]:
+        """Return the next cached photo URL for an operator, or None on a miss.
+
+        Candidates are shuffled when stored and handed out in turn, so every
+        cached photo is used once before any repeats.
+        """
+        with self.lock:
+            entry = self.candidates.get(operator)
+            if entry is None or entry[0] < time.time():
+                self.stats['candidate_misses'] += 1
+                return None
+            self.stats['candidate_hits'] += 1
+            urls = entry[1]
+            if not urls:
+                return None
+            url = urls[0]
+            urls.rotate(-1)
+            return url
+
+    def set_candidates(self, operator: str, urls: List[str]) -> Optional[str]:
+        """Store freshly searched photo URLs for an operator and hand out the first.
+
+        The search already counted as a miss, so this is not counted as a hit.
+        """
+        urls = list(urls)
+        random.shuffle(urls)
+        urls = deque(urls)
+        with self.lock:
+            self.candidates[operator] = (time.time() + self.ttl, urls)
+            if not urls:
+                return None
+            url = urls[0]
+            urls.rotate(-1)
+            return url
+
+    def get_image(self, url: str) -> Optional[bytes]:
+        """Return cached bytes for a source URL, or None on a miss."""
+        with self.lock:
+            digest = self.index['urls'].get(url)
+            if digest and os.path.exists(self._path(digest)):
+                self.stats['image_hits'] += 1
+                os.utime(self._path(digest))
+                with open(self._path(digest), 'rb') as f:
+                    return f.read()
+            self.stats['image_misses'] += 1
+            return None
+
+    def put_image(self, url: str, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            path = self._path(digest)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data)
+            else:
+                os.utime(path)
+            self.index['urls'][url] = digest
+            self._save_index()
+        return digest
+
+    def is_rejected(self, url: str) -> bool:
+        with self.lock:
+            return url in self.index['rejected']
+
+    def reject(self, url: str):
+        """Remember a source URL that was too large or could not be decoded."""
+        with self.lock:
+            self.index['rejected'][url] = int(time.time())
+            self._save_index()
+
+    @staticmethod
+    def _blob_key(digest: str, account: Optional[str]) -> str:
+        # Blobs belong to the account that uploaded them
+        return f'{digest}@{account}' if account else digest
+
+    def get_blob(self, url: str, account: Optional[str] = None) -> Optional[dict]:
+        """Return the BlobRef JSON the image behind a source URL was uploaded as to an account."""
+        with self.lock:
+            digest = self.index['urls'].get(url)
+            blob = self.index['blobs'].get(self._blob_key(digest, account)) if digest else None
+            self.stats['blob_hits' if blob else 'blob_misses'] += 1
+            return blob
+
+    def put_blob(self, url: str, blob: dict, account: Optional[str] = None):
+        with self.lock:
+            digest = self.index['urls'].get(url)
+            if digest:
+                self.index['blobs'][self._blob_key(digest, account)] = blob
+                self._save_index()
+
+    def prune(self, cutoff_ts: float) -> Dict[str, int]:
+        """Delete thumbnails last used and rejections made before cutoff_ts, with their index entries."""
+        removed = {'images': 0, 'urls': 0, 'blobs': 0, 'rejected': 0}
+        with self.lock:
+            for entry in os.scandir(self.cache_dir):
+                if not entry.is_dir():
+                    continue
+                for image in os.scandir(entry.path):
+                    if image.stat().st_mtime < cutoff_ts:
+                        os.remove(image.path)
+                        removed['images'] += 1
+                if not os.listdir(entry.path):
+                    os.rmdir(entry.path)
+
+            # Source URLs and blob refs are only worth keeping while their thumbnail is
+            kept = {}
+            for url, digest in self.index['urls'].items():
+                if os.path.exists(self._path(digest)):
+                    kept[url] = digest
+            removed['urls'] = len(self.index['urls']) - len(kept)
+            self.index['urls'] = kept
+            blobs = {key: blob for key, blob in self.index['blobs'].items()
+                     if os.path.exists(self._path(key.split('@', 1)[0]))}
+            removed['blobs'] = len(self.index['blobs']) - len(blobs)
+            self.index['blobs'] = blobs
+            # Rejected images may have been replaced at the same URL since
+            rejected = {url: ts for url, ts in self.index['rejected'].items() if ts >= cutoff_ts}
+            removed['rejected'] = len(self.index['rejected']) - len(rejected)
+            self.index['rejected'] = rejected
+
+            if any(removed.values()):
+                self._save_index()
+        return removed
@@ -0,0 +1,75 @@
+import hashlib
+import logging
+from typing import Dict, Iterable, Optional, Tuple
+
+from store import DisruptionStore
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(description: str) -> str:
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+class DisruptionTracker:
+    """Diff each scrape against the active disruptions and record what changed.
+
+    The active set is held in memory as {link: content hash}, loaded once at
+    startup, so a cycle only compares hashes and writes the rows that appeared,
+    changed or cleared. Unchanged disruptions cost no database work.
+    """
+
+    def __init__(self, store: DisruptionStore):
+        self.store = store
+        self.active: Dict[str, Optional[str]] = store.get_active_hashes()
+
+    def apply(self, rows: Iterable[Tuple[str, str, str]], now: str,
+              meta: Optional[Dict[str, Optional[str]]] = None) -> Dict[str, int]:
+        """Apply one scrape of (description, link, date) rows, returning counts per event.
+
+        meta values are saved in the same transaction as the changes, even when
+        nothing changed.
+        """
+        seen = {}
+        for description, link, date in rows:
+            seen[link] = (description, content_hash(description), date)
+
+        updated, resumed, candidates = [], [], []
+        for link, (description, digest, date) in seen.items():
+            if link not in self.active:
+                candidates.append(link)
+            elif self.active[link] != digest:
+                # Rows from before lifecycle tracking have no hash, fill it in silently
+                (updated if self.active[link] is not None else resumed).append((description, link, digest))
+
+        # Links not in the active set are new, or listed again after clearing
+        appeared, reopened = [], []
+        known = self.store.get_hashes(candidates) if candidates else {}
+        for link in candidates:
+            description, digest, date = seen[link]
+            if link not in known:
+                appeared.append((description, link, digest, date))
+            elif known[link] is None:
+                resumed.append((description, link, digest))
+            elif known[link] != digest:
+                updated.append((description, link, digest))
+            else:
+                reopened.append((description, link, digest))
+
+        cleared = [link for link in self.active if link not in seen]
+        if cleared and not seen:
+            # An empty list next to active disruptions is more likely a parse failure than a clear network
+            logger.warning(f"Scrape found no disruptions while {len(cleared)} are active, not clearing them.")
+            cleared = []
+
+        if appeared or updated or reopened or resumed or cleared or meta:
+            self.store.apply_changes(appeared, updated, reopened, resumed, cleared, now, meta)
+            for description, link, digest, _ in appeared:
+                self.active[link] = digest
+            for description, link, digest in updated + reopened + resumed:
+                self.active[link] = digest
+            for link in cleared:
+                del self.active[link]
+
+        return {'appeared': len(appeared), 'updated': len(updated), 'reopened': len(reopened),
+                'resumed': len(resumed), 'cleared': len(cleared)}
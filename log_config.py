@@ -0,0 +1,88 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+from typing import Dict, Optional
+
+# Defaults, each can be overridden by LOG_* environment variables or the CLI
+LOG_LEVEL = 'INFO'
+LOG_FILE = 'disruptions_log.txt'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+
+# Chatty third-party loggers and the level they are held at
+LIBRARY_LEVELS = 'httpx=WARNING,httpcore=WARNING,hpack=WARNING,urllib3=WARNING,atproto=WARNING,atproto_client=WARNING,atproto_core=WARNING'
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """Parse 'httpx=WARNING,atproto=ERROR' into {logger name: level}."""
+    levels = {}
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        name, level = part.split('=', 1)
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def _file_handler(path: str, max_bytes: int, backups: int, when: Optional[str]) -> logging.Handler:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if when:
+        return logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backups, encoding='utf-8')
+    return logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+
+
+def setup_logging(level: Optional[str] = None, path: Optional[str] = None, library_levels: Optional[str] = None):
+    """Send all logging through a queue to a background thread that writes the console and a rotating file.
+
+    The calling thread only puts the record on an in-memory queue, so disk
+    writes never sit on the posting path. Calling it again replaces the
+    previous configuration.
+    """
+    global _listener
+
+    level = (level or os.getenv('LOG_LEVEL', LOG_LEVEL)).upper()
+    path = path if path is not None else os.getenv('LOG_FILE', LOG_FILE)
+    max_bytes = int(os.getenv('LOG_MAX_BYTES', str(LOG_MAX_BYTES)))
+    backups = int(os.getenv('LOG_BACKUPS', str(LOG_BACKUPS)))
+    when = os.getenv('LOG_ROTATE_WHEN') or None
+    library_levels = library_levels if library_levels is not None else os.getenv('LOG_LIBRARY_LEVELS', LIBRARY_LEVELS)
+
+    if _listener is not None:
+        _listener.stop()
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if path:
+        handlers.append(_file_handler(path, max_bytes, backups, when))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    for name, library_level in parse_levels(library_levels).items():
+        logging.getLogger(name).setLevel(library_level)
+
+
+def stop_logging():
+    """Flush and stop the background writer."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,82 @@
+import logging
+import time
+from typing import Dict, Optional
+
+from image_cache import ImageCache, IMAGE_CACHE_DAYS
+from store import DisruptionStore
+
+logger = logging.getLogger(__name__)
+
+
+# Disruptions no longer listed are archived this many days after their last change
+RETENTION_DAYS = 30
+
+# Archived rows are appended to this database, empty to delete them instead
+ARCHIVE_PATH = 'disruptions-archive.db'
+
+# Hours between maintenance runs
+MAINTENANCE_HOURS = 24
+
+# Queries the posting cycle runs every time, timed before and after each run
+_HOT_QUERIES = {
+    'active_hashes': DisruptionStore.get_active_hashes,
+    'unposted': DisruptionStore.get_unposted_disruptions,
+    'due_deliveries': lambda store: store.get_due_deliveries(time.time()),
+}
+
+
+class Maintenance:
+    """Keeps the hot disruption tables small: archives old rows, then compacts and re-analyzes.
+
+    Thumbnails and rejections in the image cache that have not been used for
+    image_cache_days are pruned on the same schedule. The time of the last run is kept in the meta table, so restarts do not
+    trigger an extra run.
+    """
+
+    def __init__(self, store: DisruptionStore, retention_days: float = RETENTION_DAYS,
+                 archive_path: Optional[str] = ARCHIVE_PATH, interval_hours: float = MAINTENANCE_HOURS,
+                 image_cache: Optional[ImageCache] = None, image_cache_days: float = IMAGE_CACHE_DAYS):
+        self.store = store
+        self.retention = retention_days * 86400
+        self.archive_path = archive_path or None
+        self.interval = interval_hours * 3600
+        self.image_cache = image_cache
+        self.image_cache_age = image_cache_days * 86400
+
+    def due(self) -> bool:
+        last_run = self.store.get_meta('last_maintenance')
+        return last_run is None or time.time() - float(last_run) >= self.interval
+
+    def _measure(self) -> Dict[str, float]:
+        report = dict(self.store.size_stats())
+        for name, query in _HOT_QUERIES.items():
+            start = time.perf_counter()
+            query(self.store)
+            report[f'{name}_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        return report
+
+    def run(self) -> Dict[str, Dict[str, float]]:
+        """Run maintenance once and return the measurements from before and after."""
+        before = self._measure()
+        start = time.perf_counter()
+        disruptions, events = self.store.archive_inactive(int(time.time() - self.retention), self.archive_path)
+        converted = self.store.compact()
+        elapsed = time.perf_counter() - start
+        after = self._measure()
+        pruned = self.image_cache.prune(time.time() - self.image_cache_age) if self.image_cache else {}
+        self.store.set_meta('last_maintenance', str(time.time()))
+
+        logger.info(f"Maintenance archived {disruptions} disruptions and {events} events to "
+                    f"{self.archive_path or 'nowhere (deleted)'}{', converted to incremental vacuum' if converted else ''} "
+                    f"in {elapsed:.2f}s.")
+        logger.info(f"Database before maintenance: {before}")
+        logger.info(f"Database after maintenance: {after}")
+        if pruned:
+            logger.info(f"Pruned from the image cache: {pruned}")
+        return {'before': before, 'after': after, 'archived': {'disruptions': disruptions, 'events': events, 'seconds': elapsed},
+                'pruned': pruned}
+
+    def run_if_due(self) -> Optional[Dict[str, Dict[str, float]]]:
+        if not self.due():
+            return None
+        return self.run()
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# Histogram bucket upper bounds in seconds, from a SQLite write up to a slow upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# A collector returns (kind, name, labels, value) samples computed at scrape time
+Sample = Tuple[str, str, Dict[str, str], float]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    """Counters, gauges and latency histograms, rendered as Prometheus text or JSON."""
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters: Dict[tuple, float] = {}
+        self.gauges: Dict[tuple, float] = {}
+        self.histograms: Dict[tuple, list] = {}
+        self.collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, str]) -> tuple:
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, stage: str, **labels):
+        """Observe the duration of a block in natrail_stage_seconds{stage=...}, plus any extra labels."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('natrail_stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]):
+        self.collectors.append(collector)
+
+    def _samples(self) -> Tuple[Dict[tuple, float], Dict[tuple, float], Dict[tuple, list]]:
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: [list(value[0]), value[1], value[2]] for key, value in self.histograms.items()}
+        for collector in self.collectors:
+            try:
+                for kind, name, labels, value in collector():
+                    (counters if kind == 'counter' else gauges)[self._key(name, labels)] = value
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+        return counters, gauges, histograms
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        counters, gauges, histograms = self._samples()
+        lines = []
+        for kind, samples in (('counter', counters), ('gauge', gauges)):
+            seen = set()
+            for (name, labels), value in sorted(samples.items()):
+                if name not in seen:
+                    lines.append(f'# TYPE {name} {kind}')
+                    seen.add(name)
+                lines.append(f'{name}{_label_text(dict(labels))} {value}')
+
+        seen = set()
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            if name not in seen:
+                lines.append(f'# TYPE {name} histogram')
+                seen.add(name)
+            labels = dict(labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_label_text({**labels, "le": bound})} {cumulative}')
+            lines.append(f'{name}_bucket{_label_text({**labels, "le": "+Inf"})} {count}')
+            lines.append(f'{name}_sum{_label_text(labels)} {total}')
+            lines.append(f'{name}_count{_label_text(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """Everything as plain JSON-friendly data, histograms as count/sum/mean per label set."""
+        counters, gauges, histograms = self._samples()
+
+        def flat(samples):
+            return [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(samples.items())]
+
+        return {
+            'time': time.time(),
+            'counters': flat(counters),
+            'gauges': flat(gauges),
+            'histograms': [
+                {'name': name, 'labels': dict(labels), 'count': count, 'sum': total,
+                 'mean': total / count if count else 0.0,
+                 'buckets': dict(zip(map(str, self.buckets), counts))}
+                for (name, labels), (counts, total, count) in sorted(histograms.items())
+            ],
+        }
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """Serve /metrics (Prometheus text) and /metrics.json from a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.render().encode(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+    def write_snapshot(self, path: str):
+        """Write snapshot() to path, replacing the previous one atomically."""
+        try:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics snapshot: {e}")
+
+    def write_snapshots(self, path: str, interval: float) -> threading.Thread:
+        """Write snapshot() to path every interval seconds from a background thread."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.write_snapshot(path)
+
+        thread = threading.Thread(target=loop, name='metrics-snapshot', daemon=True)
+        thread.start()
+        return thread
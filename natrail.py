@@ -1,35 +1,36 @@
-import flickrapi
-from groq import Groq
+from __future__ import annotations
+
+import argparse
+import hashlib
 import httpx
 import json
 import logging
 import os
 import random
 import re
-import requests
-import sqlite3
 import time
+import sys
 import typing as t
-from atproto import Client
-from atproto import models
-from atproto_client.models.blob_ref import BlobRef
-from bs4 import BeautifulSoup
 from datetime import datetime
 from dotenv import load_dotenv
-from requests.exceptions import HTTPError
-from typing import List, Dict, Tuple
-# Added for when running via a proxy
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-
-
-# Set sessions
-session = requests.Session()
-
-# Proxy for debugging.
+from extract import extract_disruptions, extract_operator_slug
+from facets import FacetBuilder
+from feed import DisruptionFeed
+from http_client import client_from_env
+from metrics import Metrics
+from outbox import FAILED, MAX_ATTEMPTS, PENDING, PREPARED, retry_delay
+from image_cache import ImageCache, CACHE_DIR, IMAGE_CACHE_DAYS
+from lifecycle import DisruptionTracker
+from log_config import setup_logging
+from maintenance import Maintenance, ARCHIVE_PATH, MAINTENANCE_HOURS, RETENTION_DAYS
+from scheduler import PollScheduler, DEFAULT_PROFILE, MAX_INTERVAL, MIN_INTERVAL
+from sinks import DeliveryError, RateLimited, Sink, load_sinks, SINKS_FILE
+from store import DisruptionStore, DB_PATH
+from thumbnail import download, make_thumbnail, MAX_DOWNLOAD_BYTES, TARGET_BYTES
+
+
+# Proxy for debugging, set HTTP_VERIFY=0 when its certificate is not trusted.
 http_proxy = ""
-os.environ['HTTP_PROXY'] = http_proxy
-os.environ['HTTPS_PROXY'] = http_proxy
 
 
 # List of 20 real user agents
@@ -56,197 +57,254 @@ user_agents = [
     "Mozilla/5.0 (Windows NT 6.1; Trident/7.0; AS; rv:11.0) like Gecko"
 ]
 
-# Pick a random User Agent.
-random_user_agent = random.choice(user_agents)
+# Random User Agent for this run, picked by init().
+random_user_agent = None
 
-# Default headers for all requests
-headers = {"Upgrade-Insecure-Requests":"1","Priority":"u=0, i","User-Agent":random_user_agent,"Sec-Fetch-Dest":"document","Sec-Fetch-Site":"none","Sec-Fetch-User":"?1","Accept-Language":"en-US,en;q=0.5","Sec-Fetch-Mode":"navigate"}
+# Load environment variables from .env file
+load_dotenv()
 
+logger = logging.getLogger('natrail')
 
+# URL of the National Rail status and disruptions page, url gets a cachebuster in init()
+base_url = "https://www.nationalrail.co.uk/status-and-disruptions/"
+url = base_url
 
-# Load environment variables from .env file
-load_dotenv()
+# Conditional fetch sends If-None-Match/If-Modified-Since to the plain page URL
+# and skips parsing when the disruption list has not changed. Set
+# CONDITIONAL_FETCH=0 to always download and parse the cachebusted page.
+conditional_fetch = os.getenv('CONDITIONAL_FETCH', '1') != '0'
 
-# Set up logging to track the process, both in the console and in a file
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+# Outcome of each fetch cycle: 304, unchanged list hash or a real change
+fetch_stats = {'not_modified': 0, 'unchanged': 0, 'changed': 0, 'bytes': 0}
 
-# Console handler for logging to the CLI
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
+# Result of the latest fetch, read by the poll scheduler
+last_fetch = {'outcome': None, 'changes': 0}
 
-# Absolute file path for logs
-log_file_path = '/home/u/natrail/disruptions_log.txt'
+# Shared pooled HTTP client that every fetch goes through, created by init()
+http = None
 
-# File handler for logging to a log file
-file_handler = logging.FileHandler(log_file_path)
-file_handler.setLevel(logging.DEBUG)
+# Bluesky accounts, Mastodon accounts and webhooks every disruption goes to, loaded
+# by init() from SINKS_FILE. Without the file it is the one account in BLUESKY_HANDLE.
+sinks_file = os.getenv('SINKS_FILE', SINKS_FILE)
+sinks: t.List[Sink] = []
 
-# Log format
-log_format = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(log_format)
-file_handler.setFormatter(log_format)
+# Single long-lived connection to the disruption database, opened by init()
+store = None
 
-# Add the handlers to the logger
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+# Diffs each scrape against the active disruptions: appeared, updated, listed again and cleared
+tracker = None
 
-# Generate a random 5-digit number
-random_number = random.randint(10000, 99999)
+# Archives old cleared disruptions and compacts the database on a schedule
+maintenance = None
 
-# URL of the National Rail status and disruptions page
-url = "https://www.nationalrail.co.uk/status-and-disruptions/?cachebuster="+str(random_number)+""
+# Active disruptions as JSON and Atom, re-rendered only after a change and served when FEED_PORT is set
+feed = None
 
-# Retrieve Bluesky credentials from environment variables
-bluesky_handle = os.getenv('BLUESKY_HANDLE')
-bluesky_password = os.getenv('BLUESKY_PASSWORD')
+# Follow-up replies for updated, relisted and cleared disruptions, given up after this many failures on a sink
+LIFECYCLE_REPLY_ATTEMPTS = 3
 
-if not bluesky_handle or not bluesky_password:
-    logger.error("Bluesky credentials are not set in the .env file.")
-    raise ValueError("Missing Bluesky credentials in the .env file.")
+# Flickr photo candidates per operator, downloaded images and their blob refs
+image_cache = None
 
-# Initialize the Bluesky client
-client = Client()
+# Per-stage latency histograms, counters and gauges, optionally served over HTTP
+metrics = Metrics()
 
 
-# Patterns for Og title etc
-_META_PATTERN = re.compile(r'<meta property="og:.*?>')
-_CONTENT_PATTERN = re.compile(r'<meta[^>]+content="([^"]+)"')
+def _collect_component_stats():
+    """Expose the stats dicts kept by the other components as metrics."""
+    names = {'candidate': 'flickr_candidates', 'image': 'image_bytes', 'blob': 'blob_refs'}
+    for key, value in (image_cache.stats if image_cache else {}).items():
+        cache, result = key.rsplit('_', 1)
+        yield 'counter', f'natrail_cache_{result}_total', {'cache': names[cache]}, value
+    for outcome in ('not_modified', 'unchanged', 'changed'):
+        yield 'counter', 'natrail_fetch_total', {'outcome': outcome}, fetch_stats[outcome]
+    yield 'counter', 'natrail_fetch_bytes_total', {}, fetch_stats['bytes']
+    for sink in sinks:
+        if hasattr(sink, 'login_stats'):
+            yield 'counter', 'natrail_logins_total', {'sink': sink.name}, sink.login_stats['logins']
+            yield 'counter', 'natrail_session_reuses_total', {'sink': sink.name}, sink.login_stats['session_reuses']
+    for state, count in (store.outbox_counts() if store else {}).items():
+        yield 'gauge', 'natrail_outbox_entries', {'state': state}, count
+    for (sink, state), count in (store.delivery_counts() if store else {}).items():
+        yield 'gauge', 'natrail_deliveries', {'sink': sink, 'state': state}, count
+    for outcome, count in (feed.stats if feed else {}).items():
+        yield 'counter', 'natrail_feed_total', {'outcome': outcome}, count
+    for host, stats in (http.stats if http else {}).items():
+        yield 'counter', 'natrail_http_requests_total', {'host': host}, stats['requests']
+        yield 'counter', 'natrail_http_errors_total', {'host': host}, stats['errors']
+        yield 'counter', 'natrail_http_seconds_total', {'host': host}, stats['seconds']
 
 
+metrics.add_collector(_collect_component_stats)
 
-def extract_first_operator_link(url):
-    # Send a GET request to the specified URL
-    response = requests.get(url)
-    
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Parse the HTML content
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Find all <a> tags
-        links = soup.find_all('a', href=True)
-        
-        # Filter links that contain '/travel-information/operators/'
-        operator_links = [link['href'] for link in links if '/travel-information/operators/' in link['href']]
-        
-        # Check if any links were found
-        if operator_links:
-            # Get the first link and strip '/travel-information/operators/' from it
-            first_link = operator_links[0].replace('/travel-information/operators/', '')
-            first_link = first_link.replace('/','')
-            logger.info(f"Operater Found: {first_link}")
-            return first_link
-        else:
-            print("No links found containing '/travel-information/operators/'")
-            return "Merseyrail"
-    else:
-        print(f"Failed to retrieve the webpage. Status code: {response.status_code}")
-        return "Merseyrail"
+# Hashtags for station and operator names from the local gazetteer, plus links,
+# loaded on the first message built
+facet_builder = None
 
+# Seconds between posts when posting one at a time
+post_delay = float(os.getenv('POST_DELAY_SECONDS', '120'))
 
+# Outbox attempts before a post is given up, and the shortest wait before a retry cycle
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', str(MAX_ATTEMPTS)))
+OUTBOX_MIN_WAIT = 10
 
+# Every sink posts from its own queue under its own token bucket. Concurrent mode
+# enriches pending disruptions in parallel and posts as fast as the buckets allow,
+# instead of one enrichment at a time and post_delay between each sink's posts.
+concurrent_posting = os.getenv('CONCURRENT_POSTING', '0') == '1'
+enrich_concurrency = int(os.getenv('ENRICH_CONCURRENCY', '4'))
+
+# Default bucket for each sink, a sink in SINKS_FILE can set its own
+posts_per_minute = float(os.getenv('POSTS_PER_MINUTE', '2'))
+post_burst = int(os.getenv('POST_BURST', '3'))
+
+# Poll interval follows the recent change rate and time of day, with backoff on errors
+poll_scheduler = PollScheduler(
+    min_interval=int(os.getenv('POLL_MIN_SECONDS', str(MIN_INTERVAL))),
+    max_interval=int(os.getenv('POLL_MAX_SECONDS', str(MAX_INTERVAL))),
+    profile=os.getenv('POLL_PROFILE', DEFAULT_PROFILE),
+)
 
-def search_random_image(link):
-    # Get API key and secret from environment variables
-    api_key = os.getenv('FLICKR_API_KEY')
-    api_secret = os.getenv('FLICKR_API_SECRET')
-    search_string = ''+extract_first_operator_link(link)+' Train photo'
-    # Initialize the Flickr API
-    flickr = flickrapi.FlickrAPI(api_key, api_secret, format='parsed-json')
-
-    # Search for photos using the provided search string
-    response = flickr.photos.search(text=search_string, per_page=10)  # Fetch 10 images
-
-    # Extract photos from the response
-    photos = response['photos']['photo']
-    
-    # Check if any photos were found
-    if photos:
-        # Choose a random photo from the list
-        random_photo = random.choice(photos)
-        # Construct the URL for the image
-        image_url = f"https://live.staticflickr.com/{random_photo['server']}/{random_photo['id']}_{random_photo['secret']}.jpg"
-        logger.info(f"Image URL: {image_url}")
-        return image_url
-    else:
-        return None
 
+# Disruption list fragment, from the first list item to the end of its list
+_DISRUPTION_LIST_PATTERN = re.compile(r'<li[^>]*StyledNotificationListItem.*?</li>\s*</ul>', re.DOTALL)
 
+# Flickr REST endpoint used for the photo search
+FLICKR_REST_URL = 'https://api.flickr.com/services/rest/'
 
+# Flickr size suffix asked for when the photo has one (w is 400px on the long edge)
+flickr_size = os.getenv('FLICKR_SIZE', 'w')
 
+# Thumbnail downloads stop at this many bytes, results are recompressed to fit the target
+thumb_max_download_bytes = int(os.getenv('THUMB_MAX_DOWNLOAD_BYTES', str(MAX_DOWNLOAD_BYTES)))
+thumb_target_bytes = int(os.getenv('THUMB_TARGET_BYTES', str(TARGET_BYTES)))
 
+# Patterns for Og title etc
+_META_PATTERN = re.compile(r'<meta property="og:.*?>')
+_CONTENT_PATTERN = re.compile(r'<meta[^>]+content="([^"]+)"')
 
 
-# Initialize the SQLite database
-def create_db():
-    # Connect to SQLite database (or create it if it doesn't exist)
-    conn = sqlite3.connect('disruptions.db')
-    cursor = conn.cursor()
+def init() -> None:
+    """Open the database and caches, load the sinks and pick this run's user agent and cachebuster.
 
-    # Create table if it doesn't exist
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS disruptions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        disruption TEXT NOT NULL,
-        link TEXT NOT NULL,
-        posted INTEGER DEFAULT 0,
-        date TEXT NOT NULL
-    )
-    ''')
+    Nothing here imports atproto, so commands that only fetch start quickly.
+    """
+    global random_user_agent, url, http, store, tracker, maintenance, image_cache, sinks, feed
+
+    os.environ['HTTP_PROXY'] = http_proxy
+    os.environ['HTTPS_PROXY'] = http_proxy
 
-    # Commit and close
-    conn.commit()
-    conn.close()
+    # Pick a random User Agent and a random 5-digit cachebuster
+    random_user_agent = random.choice(user_agents)
+    url = base_url+"?cachebuster="+str(random.randint(10000, 99999))+""
 
-def insert_disruption(description, link, date):
-    """Inserts a new disruption into the database."""
-    conn = sqlite3.connect('disruptions.db')
-    cursor = conn.cursor()
+    http = client_from_env()
+    store = DisruptionStore(DB_PATH)
+    tracker = DisruptionTracker(store)
+    image_cache = ImageCache(CACHE_DIR)
+    maintenance = Maintenance(
+        store,
+        retention_days=float(os.getenv('RETENTION_DAYS', str(RETENTION_DAYS))),
+        archive_path=os.getenv('ARCHIVE_PATH', ARCHIVE_PATH),
+        interval_hours=float(os.getenv('MAINTENANCE_HOURS', str(MAINTENANCE_HOURS))),
+        image_cache=image_cache,
+        image_cache_days=float(os.getenv('IMAGE_CACHE_DAYS', str(IMAGE_CACHE_DAYS))),
+    )
+    feed = DisruptionFeed(store)
+    sinks = load_sinks(sinks_file, http, image_cache, get_thumbnail, posts_per_minute, post_burst)
 
-    # Use INSERT OR IGNORE to ensure no duplicates are added based on the description and link
-    cursor.execute('''
-        INSERT OR IGNORE INTO disruptions (disruption, link, posted, date)
-        VALUES (?, ?, 0, ?)
-    ''', (description, link, date))
 
-    conn.commit()
-    conn.close()
+def extract_first_operator_link(url):
+    # Operator slug from the (cached) detail page
+    first_link = get_page_metadata(url)['operator']
 
+    # Check if any links were found
+    if first_link:
+        logger.info(f"Operater Found: {first_link}")
+        return first_link
+    else:
+        logger.info("No links found containing '/travel-information/operators/'")
+        return "Merseyrail"
 
-def update_posted(link):
-    conn = sqlite3.connect('disruptions.db')
-    cursor = conn.cursor()
 
-    # Update the 'posted' column to 1 where the disruption and link match
-    cursor.execute('''
-    UPDATE disruptions
-    SET posted = 1
-    WHERE link = ?
-    ''', (link,))  # Ensure link is passed as a tuple
+def search_random_image(link):
+    operator = extract_first_operator_link(link)
+
+    # One worker searches on a miss, the others wait and then rotate through what it cached
+    with image_cache.operator_lock(operator):
+        # Rotate through the cached photos for this operator while they are fresh
+        image_url = image_cache.next_candidate(operator)
+        if image_url:
+            logger.info(f"Image URL (cached): {image_url}")
+            return image_url
+
+        # Get API key from environment variables
+        api_key = os.getenv('FLICKR_API_KEY')
+        search_string = ''+operator+' Train photo'
+
+        # Search for photos using the provided search string, photos.search needs no signing
+        with metrics.time('flickr_search'):
+            response = http.get(FLICKR_REST_URL, params={
+                'method': 'flickr.photos.search',
+                'api_key': api_key,
+                'text': search_string,
+                'per_page': 10,  # Fetch 10 images
+                'extras': f'url_{flickr_size}',
+                'format': 'json',
+                'nojsoncallback': 1,
+            })
+        response.raise_for_status()
+
+        # Extract photos from the response
+        photos = response.json()['photos']['photo']
+
+        # Check if any photos were found
+        if photos:
+            # Cache the URL of every photo found and hand out the first
+            # Prefer the smaller size when Flickr has one, else the default 500px image
+            image_url = image_cache.set_candidates(operator, [
+                photo.get(f'url_{flickr_size}') or f"https://live.staticflickr.com/{photo['server']}/{photo['id']}_{photo['secret']}.jpg"
+                for photo in photos
+            ])
+            logger.info(f"Image URL: {image_url}")
+            return image_url
+        else:
+            return None
 
-    conn.commit()
-    conn.close()
-    logger.debug(link)
-    logger.info(f"Updated 'posted' to 1 for disruption with link: {link}")
-    
-    
-# Function to fetch all unposted disruptions from the database
-def get_unposted_disruptions():
-    conn = sqlite3.connect('disruptions.db')
-    cursor = conn.cursor()
 
-    # Retrieve all disruptions where posted = 0
-    cursor.execute('''
-    SELECT disruption, link FROM disruptions WHERE posted = 0
-    ''')
+def get_thumbnail(img_url: str) -> t.Optional[bytes]:
+    """Download an image once and shrink it to a thumbnail, cached for every sink that uploads it.
 
-    # Fetch all the unposted disruptions
-    unposted_disruptions = cursor.fetchall()
+    Returns None for images that are too large or cannot be decoded, the
+    post then goes out without a thumbnail.
+    """
+    if image_cache.is_rejected(img_url):
+        return None
 
-    conn.close()
+    img_data = image_cache.get_image(img_url)
+    if img_data is None:
+        with metrics.time('image_download'):
+            raw = download(http, img_url, thumb_max_download_bytes)
+        if raw is not None:
+            with metrics.time('thumbnail'):
+                img_data = make_thumbnail(raw, target_bytes=thumb_target_bytes)
+        if img_data is None:
+            metrics.inc('natrail_thumbnails_rejected_total')
+            image_cache.reject(img_url)
+            return None
+        logger.info(f"Thumbnail for {img_url}: {len(raw)} bytes downloaded, {len(img_data)} bytes to upload")
+        image_cache.put_image(img_url, img_data)
+        logger.info(f"Image cache stats: {image_cache.stats}")
+    return img_data
+
+
+def _disruption_list_fragment(html: str) -> str:
+    """Return the part of the page holding the disruption list, or the whole page."""
+    match = _DISRUPTION_LIST_PATTERN.search(html)
+    if match:
+        return match.group(0)
 
-    return unposted_disruptions
+    return html
 
 
 def fetch_disruptions(random_user_agent):
@@ -265,42 +323,82 @@ def fetch_disruptions(random_user_agent):
         }
 
         # Send a request to fetch the HTML content of the page
-        response = requests.get(url, headers=headers, verify=False)
+        if conditional_fetch:
+            etag = store.get_meta('etag')
+            last_modified = store.get_meta('last_modified')
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+            with metrics.time('national_rail_fetch'):
+                response = http.get(base_url, headers=headers)
+        else:
+            with metrics.time('national_rail_fetch'):
+                response = http.get(url, headers=headers)
+
+        last_fetch['changes'] = 0
+        if response.status_code == 304:
+            last_fetch['outcome'] = 'not_modified'
+            fetch_stats['not_modified'] += 1
+            logger.info(f"Disruption page not modified (304). Fetch stats: {fetch_stats}")
+            return []
+
         response.raise_for_status()  # Raise an exception if there's an error
         logger.info("Successfully fetched data from National Rail website.")
         response.encoding = 'utf-8'
-        
-        # Parse the HTML content using BeautifulSoup
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        # Find all the disruption list items
-        disruptions = soup.find_all('li', class_='styled__StyledNotificationListItem-sc-nisfz3-3')
+        fetch_stats['bytes'] += len(response.content)
+
+        # Validators for the next cycle, only saved once this page has been processed
+        validators = None
+        if conditional_fetch:
+            # Skip parsing and DB work when the disruption list is unchanged
+            fragment = _disruption_list_fragment(response.text)
+            validators = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fragment_hash': hashlib.sha256(fragment.encode('utf-8')).hexdigest(),
+            }
+            if validators['fragment_hash'] == store.get_meta('fragment_hash'):
+                store.set_metas(validators)
+                last_fetch['outcome'] = 'unchanged'
+                fetch_stats['unchanged'] += 1
+                logger.info(f"Disruption list unchanged. Fetch stats: {fetch_stats}")
+                return []
+
+        last_fetch['outcome'] = 'changed'
+        fetch_stats['changed'] += 1
+        logger.info(f"Disruption list changed. Fetch stats: {fetch_stats}")
+
+        # Pull only the disruption links out of the page
+        with metrics.time('parse'):
+            disruptions = extract_disruptions(response.text)
 
         disruptions_list = []
 
-        for disruption in disruptions:
-            link = disruption.find('a', class_='styled__StyledNotificationBox-sc-2fuu9j-2')
-            if link:
-                aria_label = link.get('aria-label', 'No description available').strip()
-                href = link.get('href', '#').strip()
-
-                # Ensure the link has the full URL
-                full_link = f"https://www.nationalrail.co.uk{href}"
-
-                # Get the current date for the disruption
-                date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-                # Save disruption to the database
-                insert_disruption(aria_label, full_link, date)
-
-                # Add the disruption to the list
-                disruptions_list.append((aria_label, full_link, date))
-
-        # Log the number of new disruptions
-        logger.info(f"Found {len(disruptions_list)} new disruptions.")
+        for aria_label, href in disruptions:
+            # Ensure the link has the full URL
+            full_link = f"https://www.nationalrail.co.uk{href}"
+
+            # Get the current date for the disruption
+            date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+            # Add the disruption to the list
+            disruptions_list.append((aria_label, full_link, date))
+
+        # Write what changed since the last scrape and the validators in one transaction
+        with metrics.time('db_write'):
+            changes = tracker.apply(disruptions_list, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), validators)
+        if any(changes.values()):
+            feed.invalidate()
+        for event in ('appeared', 'updated', 'reopened', 'cleared'):
+            metrics.inc('natrail_disruption_events_total', changes[event], event=event)
+        last_fetch['changes'] = changes['appeared'] + changes['updated'] + changes['reopened'] + changes['cleared']
+        logger.info(f"Found {len(disruptions_list)} disruptions, {changes['appeared']} new, {changes['updated']} updated, "
+                    f"{changes['reopened']} listed again, {changes['cleared']} cleared.")
         return disruptions_list
 
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
+        last_fetch['outcome'] = 'error'
         logger.error(f"Error fetching disruptions: {e}")
         return []
 
@@ -329,191 +427,398 @@ def _get_og_tag_value(og_tags: t.List[str], tag_name: str) -> t.Optional[str]:
     return None
 
 
-def get_og_tags(url: str) -> t.Tuple[t.Optional[str], t.Optional[str], t.Optional[str]]:
-    response = httpx.get(url)
-    response.raise_for_status()
-
-    og_tags = _META_PATTERN.findall(response.text)
-
-    og_image = _get_og_tag_value(og_tags, 'og:image')
-    og_title = _get_og_tag_value(og_tags, 'og:title')
-    og_description = _get_og_tag_value(og_tags, 'og:description')
-
-    return og_image, og_title, og_description
-
-
-
-
-def modify_string(text):
-    # Find the first capital letter after 'between' and 'and'
-    text = re.sub(r'(between[^A-Z]*)([A-Z])', r'\1#\2', text)
-    # Find the first capital letter after 'and'
-    text = re.sub(r'(and[^A-Z]*)([A-Z])', r'\1#\2', text)
-    text = re.sub(r'(from[^A-Z]*)([A-Z])', r'\1#\2', text)
-    text = re.sub(r'\b(Northern|Merseyrail)\b', r'#\1', text)
-    return text
+def get_page_metadata(link: str) -> t.Dict[str, t.Optional[str]]:
+    """Fetch a disruption detail page once and return everything the post needs from it.
+
+    Results are cached per link in the database, so retries and restarts do
+    not download the page again. The row is dropped when the disruption's
+    text changes or it is archived, so the next read fetches the page again.
+    """
+    metadata = store.get_page_metadata(link)
+    if metadata is None:
+        metrics.inc('natrail_cache_misses_total', cache='page_metadata')
+        with metrics.time('detail_fetch'):
+            response = http.get(link)
+        response.raise_for_status()
+
+        og_tags = _META_PATTERN.findall(response.text)
+        metadata = {
+            'og_image': _get_og_tag_value(og_tags, 'og:image'),
+            'title': _get_og_tag_value(og_tags, 'og:title'),
+            'description': _get_og_tag_value(og_tags, 'og:description'),
+            'operator': extract_operator_slug(response.text),
+        }
+        store.set_page_metadata(link, metadata, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    else:
+        metrics.inc('natrail_cache_hits_total', cache='page_metadata')
+    return metadata
 
-def extract_hashtag_byte_positions(text: str, *, encoding: str = 'UTF-8') -> List[Tuple[str, int, int]]:
-    """This function will detect hashtags."""
-    encoded_text = text.encode(encoding)
 
-    # Hashtag matching pattern
-    pattern = rb'#\w+'
+def get_og_tags(url: str) -> t.Tuple[t.Optional[str], t.Optional[str], t.Optional[str]]:
+    metadata = get_page_metadata(url)
+    return metadata['og_image'], metadata['title'], metadata['description']
 
-    matches = re.finditer(pattern, encoded_text)
-    hashtag_byte_positions = []
 
-    for match in matches:
-        hashtag_bytes = match.group(0)
-        hashtag = hashtag_bytes.decode(encoding)
-        hashtag_byte_positions.append((hashtag, match.start(), match.end()))
 
-    return hashtag_byte_positions
 
+def build_message(description: str) -> t.Tuple[str, str, t.List[t.Dict[str, t.Any]]]:
+    """Add hashtags to a disruption and build the richtext facets for its message, as Bluesky facet JSON."""
+    global facet_builder
 
+    if facet_builder is None:
+        facet_builder = FacetBuilder()
+    description, facet_spans = facet_builder.build(description)
+    message = f"{description}\n"
+    facets = []
 
-def extract_url_byte_positions(text: str, *, encoding: str = 'UTF-8') -> t.List[t.Tuple[str, int, int]]:
-    """This function will detect any links beginning with http or https."""
-    encoded_text = text.encode(encoding)
+    for kind, value, byte_start, byte_end in facet_spans:
+        if kind == 'link':
+            feature = {'$type': 'app.bsky.richtext.facet#link', 'uri': value}
+        else:
+            feature = {'$type': 'app.bsky.richtext.facet#tag', 'tag': value}
+        facets.append({
+            '$type': 'app.bsky.richtext.facet',
+            'features': [feature],
+            'index': {'byteStart': byte_start, 'byteEnd': byte_end},
+        })
+
+    return description, message, facets
+
+
+def enrich_entry(entry: t.Dict[str, t.Any]) -> None:
+    """Build a disruption's post once and queue it for every sink that takes its operator.
+
+    The thumbnail is downloaded and shrunk here too, so sinks only upload it.
+    """
+    link = entry['link']
+    # Hashtags, facets and the link card text: og title and description
+    description, message, facets = build_message(entry['disruption'])
+    img_url, title, og_description = get_og_tags(link)
+    fields = {
+        'message': message,
+        'facets': json.dumps(facets),
+        'title': title or "National Rail Disruptions",
+        'description': og_description or description,
+        'thumb_url': None,
+        'operator': get_page_metadata(link)['operator'],
+    }
+    # The thumbnail is optional, a Flickr outage or bad image should not hold the post back
+    try:
+        fields['thumb_url'] = search_random_image(link)
+        if fields['thumb_url']:
+            logger.debug("Thumbnail image: %s", fields['thumb_url'])
+            get_thumbnail(fields['thumb_url'])
+    except Exception as e:
+        logger.warning(f"No thumbnail for {link}, posting without one: {e}")
+        fields['thumb_url'] = None
+
+    targets = [sink.name for sink in sinks if sink.accepts(fields['operator'])]
+    if not targets:
+        logger.info(f"No sink takes operator {fields['operator']}, not posting {link}")
+    store.save_enrichment(link, fields, targets)
+    if fields['operator']:
+        # The feed's operator filter only knows a disruption once its detail page has been read
+        feed.invalidate()
+
+
+def record_enrich_failure(entry: t.Dict[str, t.Any], e: Exception) -> None:
+    """Schedule another try at enriching an outbox entry, or give it up after OUTBOX_MAX_ATTEMPTS."""
+    attempts = entry['attempts'] + 1
+    logger.error(f"Failed to prepare {entry['link']} (attempt {attempts}/{OUTBOX_MAX_ATTEMPTS}): {e}")
+    fields = {'attempts': attempts, 'retry_at': int(time.time() + retry_delay(attempts)), 'last_error': str(e)[:500]}
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        fields['state'] = FAILED
+        metrics.inc('natrail_enrich_failed_total')
+        logger.error(f"Giving up on {entry['link']} after {attempts} attempts.")
+    store.update_outbox(entry['link'], **fields)
+    entry.update(fields)
+
+
+def _first_sentence(text: str) -> str:
+    return text.split('. ', 1)[0].rstrip('.')
+
+
+def build_post(sink: Sink, delivery: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+    """The post a delivery sends: the enriched disruption, or a reply to it for an update, relisting or clear."""
+    post = {
+        'link': delivery['link'],
+        'event_id': delivery['event_id'],
+        'title': delivery['title'],
+        'description': delivery['description'],
+        'thumb_url': delivery['thumb_url'],
+        'operator': delivery['operator'],
+        'root': None,
+        'parent': None,
+    }
+    if delivery['event_id'] == 0:
+        post.update(event='post', text=delivery['message'], facets=json.loads(delivery['facets'] or '[]'))
+        return post
+
+    # Replies chain onto the previous reply so a disruption reads as one thread
+    if delivery['event'] == 'updated':
+        _, message, facets = build_message(f"Update: {delivery['event_text']}")
+    elif delivery['event'] == 'reopened':
+        _, message, facets = build_message(f"Listed again: {delivery['event_text']}")
+    else:
+        message, facets = f"Resolved: {_first_sentence(delivery['event_text'])}. No longer listed by National Rail.\n", []
+    root, parent = store.get_thread(delivery['link'], sink.name, delivery['event_id'])
+    post.update(event=delivery['event'], text=message, facets=facets, root=root, parent=parent)
+    return post
+
+
+def send_delivery(sink: Sink, delivery: t.Dict[str, t.Any]) -> None:
+    """Take one delivery from wherever it stopped through to sent.
+
+    The sink's upload and the key the post is sent under are saved before
+    sending. If an earlier attempt got that far, the sink is asked whether the
+    post exists first, so a crash or timeout after the send never produces a
+    second post.
+    """
+    link, event_id = delivery['link'], delivery['event_id']
+    post = build_post(sink, delivery)
+    if delivery['state'] == PENDING:
+        # Only Bluesky uploads anything before sending, the other sinks' prepare is a no-op
+        if sink.kind == 'bluesky':
+            with metrics.time('blob_upload', sink=sink.name):
+                prepared = sink.prepare(post)
+        else:
+            prepared = sink.prepare(post)
+        key = sink.new_key(post)
+        store.update_delivery(link, event_id, sink.name, state=PREPARED, prepared=prepared, key=key)
+        delivery.update(state=PREPARED, prepared=prepared, key=key)
+    else:
+        found = sink.find(delivery['key'])
+        if found is not None:
+            logger.info(f"Post for {link} was already sent to {sink.name} before a restart or timeout: {found[1] or found[0]}")
+            store.mark_delivered(link, event_id, sink.name, *found)
+            return
+
+    # Lazy %-style arguments so large objects are only formatted when DEBUG is on
+    logger.debug("Posting to %s with message: %s", sink.name, post['text'])
+    logger.debug("Link: %s", link)
+    with metrics.time('send_post' if event_id == 0 else 'send_reply'):
+        ref, post_url = sink.send(post, delivery['prepared'], delivery['key'])
+    logger.debug("Response from %s: %s", sink.name, ref)
+
+    if event_id == 0:
+        logger.info(f"Successfully posted message to {sink.name}: {post['text']}")
+        metrics.inc('natrail_posts_total', sink=sink.name)
+    else:
+        logger.info(f"Posted {post['event']} reply for {link} to {sink.name}")
+        metrics.inc('natrail_replies_total', event=post['event'], sink=sink.name)
+    store.mark_delivered(link, event_id, sink.name, ref, post_url)
+
+
+def record_failure(sink: Sink, delivery: t.Dict[str, t.Any], e: Exception) -> None:
+    """Schedule a retry of a failed delivery, or give it up after its last attempt."""
+    limit = OUTBOX_MAX_ATTEMPTS if delivery['event_id'] == 0 else LIFECYCLE_REPLY_ATTEMPTS
+    attempts = delivery['attempts'] + 1
+    if isinstance(e, DeliveryError) and not e.counts:
+        # Not the post's fault, so it does not count as an attempt
+        attempts -= 1
+    if isinstance(e, RateLimited):
+        metrics.inc('natrail_rate_limited_total', sink=sink.name)
+        sink.bucket.pause(e.delay)
+        logger.warning(f"Rate limit reached on {sink.name}. Retrying {delivery['link']} in {e.delay:.0f} seconds.")
+    else:
+        logger.error(f"Failed to send {delivery['link']} to {sink.name} at step {delivery['state']} "
+                     f"(attempt {attempts}/{limit}): {e}")
+    delay = e.delay if isinstance(e, DeliveryError) and e.delay is not None else retry_delay(max(attempts, 1))
+
+    fields = {'attempts': attempts, 'retry_at': int(time.time() + delay), 'last_error': str(e)[:500]}
+    if attempts >= limit:
+        fields['state'] = FAILED
+        metrics.inc('natrail_posts_failed_total', sink=sink.name)
+        logger.error(f"Giving up on {delivery['link']} for {sink.name} after {attempts} attempts.")
+    metrics.inc('natrail_post_retries_total', sink=sink.name)
+    store.update_delivery(delivery['link'], delivery['event_id'], sink.name, **fields)
+    delivery.update(fields)
+
+
+def deliver(sink: Sink, delivery: t.Dict[str, t.Any]) -> bool:
+    """Send one delivery, recording any failure on it. Returns True once it is sent."""
+    try:
+        send_delivery(sink, delivery)
+        return True
+    except Exception as e:
+        record_failure(sink, delivery, e)
+        return False
+
+
+async def deliver_all(entries: t.List[t.Dict[str, t.Any]], deliveries: t.List[t.Dict[str, t.Any]]):
+    """Enrich the due outbox entries and send every due delivery, with one poster per sink.
+
+    Each post is handed to the queues of its sinks as soon as it is enriched,
+    so it goes out everywhere at once and a slow or rate limited sink only
+    holds up its own queue.
+    """
+    import asyncio
+
+    by_name = {sink.name: sink for sink in sinks}
+    queues = {sink.name: asyncio.Queue() for sink in sinks}
+    for delivery in deliveries:
+        queues[delivery['sink']].put_nowait(delivery)
+    semaphore = asyncio.Semaphore(enrich_concurrency if concurrent_posting else 1)
+
+    async def enrich(entry):
+        async with semaphore:
+            try:
+                await asyncio.to_thread(enrich_entry, entry)
+            except Exception as e:
+                await asyncio.to_thread(record_enrich_failure, entry, e)
+                return
+        for delivery in await asyncio.to_thread(store.get_due_deliveries, time.time(), list(by_name), entry['link']):
+            await queues[delivery['sink']].put(delivery)
+            metrics.set('natrail_queue_depth', queues[delivery['sink']].qsize(), sink=delivery['sink'])
+
+    async def poster(sink):
+        queue = queues[sink.name]
+        sent = False
+        while True:
+            delivery = await queue.get()
+            metrics.set('natrail_queue_depth', queue.qsize(), sink=sink.name)
+            if delivery is None:
+                break
+            if sent and not concurrent_posting:
+                await asyncio.sleep(post_delay)  # Keep the delay between posts
+            await sink.bucket.acquire()
+            sent = await asyncio.to_thread(deliver, sink, delivery)
 
-    # Adjusted URL matching pattern
-    pattern = rb'https?://[^ \n\r\t]*'
+    posters = [asyncio.create_task(poster(sink)) for sink in sinks]
+    await asyncio.gather(*(enrich(entry) for entry in entries))
+    for queue in queues.values():
+        await queue.put(None)
+    await asyncio.gather(*posters)
 
-    matches = re.finditer(pattern, encoded_text)
-    url_byte_positions = []
 
-    for match in matches:
-        url_bytes = match.group(0)
-        url = url_bytes.decode(encoding)
-        url_byte_positions.append((url, match.start(), match.end()))
+def run_maintenance() -> None:
+    """Archive and compact the database when it is due, keeping the sizes as metrics."""
+    try:
+        with metrics.time('maintenance'):
+            report = maintenance.run_if_due()
+    except Exception as e:
+        logger.error(f"Database maintenance failed: {e}")
+        return
+    if report:
+        metrics.set('natrail_db_bytes', report['after']['bytes'])
+        metrics.set('natrail_db_rows', report['after']['disruptions'])
+        metrics.inc('natrail_archived_total', report['archived']['disruptions'])
+
+
+def post_pending() -> None:
+    """Send every new disruption and every reply for updated, relisted and cleared ones to all sinks."""
+    import asyncio
+
+    # Queue disruptions that are new since the last run and replies to posted ones, then take what is due
+    names = [sink.name for sink in sinks]
+    store.enqueue_unposted()
+    store.fan_out_events(names)
+    now = time.time()
+    entries = store.get_due_outbox(now)
+    deliveries = store.get_due_deliveries(now, names)
+
+    if entries or deliveries:
+        logger.info(f"Preparing {len(entries)} disruptions and sending {len(deliveries)} waiting posts and "
+                    f"replies to {len(sinks)} sinks{' concurrently' if concurrent_posting else ''}.")
+        asyncio.run(deliver_all(entries, deliveries))
+    else:
+        logger.info("No new disruptions to post.")
 
-    return url_byte_positions
+    for name in names:
+        metrics.set('natrail_queue_depth', 0, sink=name)
 
 
+def next_sleep() -> float:
+    """Seconds until the next cycle: the poll interval, or sooner when a failed post is due a retry."""
+    interval = poll_scheduler.next_interval()
+    retry_at = store.next_outbox_retry([sink.name for sink in sinks])
+    if retry_at is not None:
+        retry_in = max(retry_at - time.time(), OUTBOX_MIN_WAIT)
+        if retry_in < interval:
+            logger.info(f"Next cycle in {retry_in:.0f}s instead of {interval:.0f}s: a failed post is due a retry")
+            interval = retry_in
+    return interval
 
 
-def post_to_bluesky(message: str, url: str, link: str, linkz: str, description: str, facets: List[models.AppBskyRichtextFacet.Main] = None):
-    """Post a disruption message to Bluesky using the atproto client."""
-    retry_attempts = 3
-    retry_delay = 120  # 2 minutes in seconds
+def run_once() -> bool:
+    """One full cycle: fetch, post and any due maintenance. Returns False if the fetch failed."""
+    try:
+        fetch_disruptions(random_user_agent)
+    except Exception:
+        # Only fetch failures back off polling, failed posts have their own retries
+        poll_scheduler.record_error()
+        raise
+    if last_fetch['outcome'] == 'error':
+        poll_scheduler.record_error()
+    else:
+        poll_scheduler.record_fetch(last_fetch['changes'] > 0)
 
-    for attempt in range(retry_attempts):
-        try:
-            # Login to Bluesky with credentials from the .env file
-            bluesky_handle = os.getenv("BLUESKY_HANDLE")
-            bluesky_password = os.getenv("BLUESKY_PASSWORD")
-            profile = client.login(bluesky_handle, bluesky_password)
-            logger.info(f"Logged in to Bluesky as {bluesky_handle}")
-            img_url, title, descriptionx = get_og_tags(link)
-            if title is None:
-               title = "National Rail Disruptions"
-            if descriptionx is None:
-               descriptionx = description
-            
-            thumb_blob = None
-            img_url = search_random_image(link)
-            if img_url:
-               # Download image from og:image url and upload it as a blob
-               logger.debug(f"{img_url}")
-               img_data = httpx.get(img_url).content
-               thumb_blob = client.upload_blob(img_data).blob
-            logger.debug(f"Posting to Bluesky with message: {message}")
-            logger.debug(f"Link: {link}")
-            logger.debug(f"Description: {description}")
-            if facets:
-               logger.debug(f"Facets: {facets}")
-            # AppBskyEmbedExternal is the same as "link card" in the app
-            embed_external = models.AppBskyEmbedExternal.Main(external=models.AppBskyEmbedExternal.External(title=title, description=descriptionx, uri=link, thumb=thumb_blob))
-            response = client.send_post(text=message, embed=embed_external, facets=facets)
-            # Log the full response to inspect the structure
-            logger.debug(f"Response from Bluesky: {response}")
-
-            # Check if the response contains the necessary fields ('did' or 'uri')
-            if 'did' not in str(response) or 'uri' not in str(response):
-                logger.error(f"Failed to post message. Response missing expected fields: {response}")
-                break  # Exit if the response doesn't have the expected fields
-
-            logger.info(f"Successfully posted message to Bluesky: {message}")
-            # Mark the disruption as posted in the database
-            update_posted(link)
-            break  # If post is successful, break out of the loop
-
-        except HTTPError as e:
-            # Check for rate limit status code (429)
-            if e.response.status_code == 429:
-                logger.warning(f"Rate limit reached. Retrying in {retry_delay} seconds... (Attempt {attempt + 1}/{retry_attempts})")
-                time.sleep(retry_delay)  # Wait for 2 minutes before retrying
-            else:
-                logger.error(f"HTTP error: {e}")
-                break
-        except Exception as e:
-            logger.error(f"Failed to post to Bluesky: {e}")
-            break  # Break the loop on other errors (non-rate-limit related)
+    post_pending()
+    run_maintenance()
+    logger.info(f"HTTP stats: {http.stats}")
+    return last_fetch['outcome'] != 'error'
 
 
 def main_loop():
     while True:
         try:
-            if not os.path.exists('disruptions.db'):
-                create_db()  # Ensure the database and table are created if they don't exist
-            
-            fetch_disruptions(random_user_agent)
-            # Fetch unposted disruptions from the database
-            unposted_disruptions = get_unposted_disruptions()
-            
-            if unposted_disruptions:
-                for description, link in unposted_disruptions:
-                    try:
-                        # Add hashtags and prepare the message
-                        description = modify_string(description)
-                        message = f"{description}\n"
-                        logger.info(f"Posting disruption: {message}")
-                        # Unaltered Link
-                        linkz = link
-                        
-                        # Parse URLs and hashtags
-                        url_positions = extract_url_byte_positions(message)
-                        hashtag_positions = extract_hashtag_byte_positions(message)
-                        facets = []
-                        
-                        for link_data in url_positions:
-                            uri, byte_start, byte_end = link_data
-                            link_facet = models.AppBskyRichtextFacet.Main(
-                                features=[models.AppBskyRichtextFacet.Link(uri=uri)],
-                                index=models.AppBskyRichtextFacet.ByteSlice(byte_start=byte_start, byte_end=byte_end),
-                            )
-                            facets.append(link_facet)
-                            
-                        for hashtag_data in hashtag_positions:
-                            hashtag, byte_start, byte_end = hashtag_data
-                            hashtag_facet = models.AppBskyRichtextFacet.Main(
-                                features=[models.AppBskyRichtextFacet.Tag(tag=hashtag)],
-                                index=models.AppBskyRichtextFacet.ByteSlice(byte_start=byte_start, byte_end=byte_end),
-                            )
-                            facets.append(hashtag_facet)
-                            
-                        # Post the message to Bluesky with the richtext facets
-                        post_to_bluesky(message, url, link, linkz, description, facets=facets)
-                        time.sleep(120)  # Keep the 2-minute delay between posts
-                        
-                    except Exception as e:
-                        logger.error(f"Error processing disruption: {e}")
-                        continue  # Continue to next disruption if one fails
-                        
-            else:
-                logger.info("No new disruptions to post.")
-                
-            logger.info("Sleeping for 20 minutes before next check...")
-            time.sleep(1200)  # 20 minutes sleep between full runs
-            
+            run_once()
+            time.sleep(next_sleep())
+
         except Exception as e:
             logger.error(f"Major error in main loop: {e}")
-            logger.info("Sleeping for 20 minutes before retry...")
-            time.sleep(1200)  # Sleep even if there's an error, then retry
-
-if __name__ == "__main__":
+            time.sleep(poll_scheduler.next_interval())  # Backs off if the fetch failed, then retry
+
+
+def main(argv: t.Optional[t.List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Post National Rail disruptions to Bluesky.")
+    parser.add_argument('--log-level', help="log level, overrides LOG_LEVEL")
+    parser.add_argument('--log-file', help="log file path, empty for console only, overrides LOG_FILE")
+    parser.add_argument('--log-library-levels', help="per-library levels such as httpx=WARNING, overrides LOG_LIBRARY_LEVELS")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.add_parser('daemon', help="poll and post until stopped (the default)")
+    commands.add_parser('run-once', help="fetch, post and run any due maintenance once, then exit")
+    commands.add_parser('fetch-only', help="fetch and store disruptions without posting")
+    commands.add_parser('post-only', help="post stored disruptions and pending replies without fetching")
+    args = parser.parse_args(argv)
+
+    # Set up logging to the console and a rotating file, written from a background
+    # thread. LOG_LEVEL, LOG_FILE and LOG_LIBRARY_LEVELS configure it.
+    setup_logging(args.log_level, args.log_file, args.log_library_levels)
+    init()
+
+    command = args.command or 'daemon'
+    ok = True
     try:
-        logger.info("Starting continuous monitoring...")
-        main_loop()
+        if command == 'daemon':
+            # Local stats endpoint, periodic JSON snapshot and disruption feed, all off unless configured
+            if os.getenv('METRICS_PORT'):
+                metrics.serve(int(os.getenv('METRICS_PORT')))
+            if os.getenv('FEED_PORT'):
+                feed.serve(int(os.getenv('FEED_PORT')), os.getenv('FEED_HOST', '127.0.0.1'))
+            if os.getenv('METRICS_SNAPSHOT_PATH'):
+                metrics.write_snapshots(os.getenv('METRICS_SNAPSHOT_PATH'), float(os.getenv('METRICS_SNAPSHOT_SECONDS', '60')))
+
+            logger.info("Starting continuous monitoring...")
+            main_loop()
+        elif command == 'run-once':
+            ok = run_once()
+        elif command == 'fetch-only':
+            fetch_disruptions(random_user_agent)
+            ok = last_fetch['outcome'] != 'error'
+        else:
+            post_pending()
     except KeyboardInterrupt:
         logger.info("Shutting down gracefully...")
+    finally:
+        # One-shot runs leave a single snapshot behind for whatever scheduled them
+        if command != 'daemon' and os.getenv('METRICS_SNAPSHOT_PATH'):
+            metrics.write_snapshot(os.getenv('METRICS_SNAPSHOT_PATH'))
+        http.close()
+        store.close()
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,47 @@
+import random
+import threading
+import time
+
+# Outbox states. A disruption is enriched once, which creates one delivery
+# per sink that takes it.
+PENDING = 'pending'
+ENRICHED = 'enriched'
+FAILED = 'failed'
+
+# Delivery states, in the order a post moves through them on one sink. A
+# delivery that fails stays at its last completed step until retry_at, then
+# resumes there. PENDING and FAILED are shared with the outbox.
+PREPARED = 'prepared'
+SENT = 'sent'
+
+# Delivery states that still have work to do
+OPEN_STATES = (PENDING, PREPARED)
+
+# Attempts before a post or delivery is marked failed, and its backoff in seconds
+MAX_ATTEMPTS = 5
+RETRY_BASE = 60
+RETRY_MAX = 3600
+
+_TID_ALPHABET = '234567abcdefghijklmnopqrstuvwxyz'
+_CLOCK_ID = random.getrandbits(10)
+_tid_lock = threading.Lock()
+_last_tid = 0
+
+
+def retry_delay(attempts: int) -> float:
+    """Seconds to wait before retrying after the given number of failed attempts."""
+    return min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+
+
+def new_rkey() -> str:
+    """Return a fresh atproto TID to use as a post's record key.
+
+    The key is saved before the post is sent, so after a crash the bot can
+    check whether the record already exists instead of posting it again.
+    """
+    global _last_tid
+    with _tid_lock:
+        # Microseconds since the epoch above a random 10-bit clock id, always increasing
+        tid = max(int(time.time() * 1_000_000) << 10 | _CLOCK_ID, _last_tid + 1)
+        _last_tid = tid
+    return ''.join(_TID_ALPHABET[(tid >> shift) & 31] for shift in range(60, -1, -5))
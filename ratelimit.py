@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` operations per second with bursts up to `capacity`.
+
+    pause() empties the bucket and blocks it for a while, which is how a 429
+    with Retry-After from the server is honoured.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        # Nothing accrues while paused
+        if now > self.blocked_until:
+            elapsed = now - max(self.updated, self.blocked_until)
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def _try_take(self) -> float:
+        """Take a token if one is free, otherwise return the seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        # Imported here so synchronous users of the bucket do not pay for asyncio
+        import asyncio
+
+        wait = self._try_take()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._try_take()
+
+    def acquire_blocking(self):
+        wait = self._try_take()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._try_take()
+
+    def pause(self, seconds: float):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            # A single token is waiting for the retry once the pause is over
+            self.tokens = 1
+            self.blocked_until = max(self.blocked_until, now + seconds)
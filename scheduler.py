@@ -0,0 +1,75 @@
+import logging
+import random
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# Poll interval bounds in seconds
+MIN_INTERVAL = 120
+MAX_INTERVAL = 1800
+
+# Hour ranges (inclusive) and the factor applied to the interval during them:
+# poll more often in the rush hours and less overnight.
+DEFAULT_PROFILE = '0-4:3,5-9:0.5,16-19:0.5'
+
+
+def parse_profile(spec: str) -> List[Tuple[int, int, float]]:
+    """Parse 'start-end:factor,...' into (start_hour, end_hour, factor) tuples."""
+    profile = []
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        hours, factor = part.split(':')
+        start, end = hours.split('-')
+        profile.append((int(start), int(end), float(factor)))
+    return profile
+
+
+class PollScheduler:
+    """Chooses how long to sleep between polls of the disruptions page.
+
+    The interval shrinks towards min_interval as the recent change rate (an
+    exponentially weighted average of cycles that found new or updated
+    disruptions) goes up, is scaled by the time-of-day profile, and after
+    fetch errors is replaced by a jittered exponential backoff.
+    """
+
+    def __init__(self, min_interval: float = MIN_INTERVAL, max_interval: float = MAX_INTERVAL,
+                 profile: str = DEFAULT_PROFILE, smoothing: float = 0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.profile = parse_profile(profile)
+        self.smoothing = smoothing
+        self.change_rate = 0.5
+        self.errors = 0
+
+    def record_fetch(self, changed: bool):
+        self.errors = 0
+        self.change_rate += self.smoothing * ((1.0 if changed else 0.0) - self.change_rate)
+
+    def record_error(self):
+        self.errors += 1
+
+    def profile_factor(self, now: Optional[datetime] = None) -> float:
+        hour = (now or datetime.now()).hour
+        for start, end, factor in self.profile:
+            if start <= hour <= end:
+                return factor
+        return 1.0
+
+    def next_interval(self, now: Optional[datetime] = None) -> float:
+        """Return the seconds to sleep before the next poll and log why."""
+        if self.errors:
+            backoff = min(self.max_interval, self.min_interval * 2 ** self.errors)
+            interval = random.uniform(backoff / 2, backoff)
+            logger.info(f"Next poll in {interval:.0f}s: backoff after {self.errors} consecutive fetch errors (cap {backoff:.0f}s)")
+            return interval
+
+        span = self.max_interval - self.min_interval
+        base = self.max_interval - span * self.change_rate
+        factor = self.profile_factor(now)
+        # A little jitter so polls do not line up with the page's own refreshes
+        interval = base * factor * random.uniform(0.9, 1.1)
+        interval = min(self.max_interval, max(self.min_interval, interval))
+        logger.info(f"Next poll in {interval:.0f}s: change rate {self.change_rate:.2f} gives {base:.0f}s, time-of-day factor {factor}, bounds {self.min_interval}-{self.max_interval}s")
+        return interval
@@ -0,0 +1,388 @@
+import abc
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from http_client import HttpClient
+from image_cache import ImageCache
+from outbox import new_rkey
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+# Sink definitions, a JSON list. Without it everything goes to one Bluesky account.
+SINKS_FILE = 'sinks.json'
+
+# Name of the Bluesky sink built from BLUESKY_HANDLE and BLUESKY_PASSWORD
+DEFAULT_SINK = 'bluesky'
+
+# Mastodon statuses longer than this are rejected by most servers
+MASTODON_LIMIT = 500
+
+# Bluesky rejects posts over 300 graphemes, counting code points stays under it
+BLUESKY_LIMIT = 300
+
+# A post handed to a sink: link, event ('post', 'updated', 'reopened' or 'cleared'), text,
+# facets (Bluesky richtext JSON), title, description, thumb_url, operator, and
+# for replies the root and parent refs of the thread on that sink.
+Post = Dict[str, Any]
+
+# What a sink returns for a delivered post: its own reference (used as the
+# parent of later replies) and a web URL for people
+Delivered = Tuple[Dict[str, Any], Optional[str]]
+
+
+class DeliveryError(Exception):
+    """A failed delivery. delay replaces the usual backoff, counts=False does not use up an attempt."""
+
+    def __init__(self, message: str, delay: Optional[float] = None, counts: bool = True):
+        super().__init__(message)
+        self.delay = delay
+        self.counts = counts
+
+
+class RateLimited(DeliveryError):
+    def __init__(self, delay: float):
+        super().__init__(f"rate limited for {delay:.0f}s", delay=delay, counts=False)
+
+
+def _retry_after(response: httpx.Response, default: float) -> float:
+    """Seconds to wait after a 429, from Retry-After or an X-RateLimit-Reset timestamp."""
+    retry_after = response.headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    reset = response.headers.get('X-RateLimit-Reset')
+    if reset:
+        try:
+            return max((datetime.fromisoformat(reset.replace('Z', '+00:00')) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except ValueError:
+            pass
+    return default
+
+
+class Sink(abc.ABC):
+    """One destination for the disruption stream, with its own rate limit.
+
+    Delivery runs in up to three steps, each saved before the next: prepare()
+    does any upload the post needs, new_key() picks the key the post is sent
+    under, and send() delivers it. find() looks a key up again after a crash
+    between sending and saving. Each kind of sink must implement send().
+    """
+
+    kind = ''
+
+    def __init__(self, name: str, operators: Optional[List[str]] = None, posts_per_minute: float = 2, burst: int = 3):
+        self.name = name
+        self.operators = {operator.lower() for operator in operators or []}
+        self.bucket = TokenBucket(rate=posts_per_minute / 60, capacity=burst)
+
+    def accepts(self, operator: Optional[str]) -> bool:
+        """Whether this sink takes disruptions for an operator slug, all of them unless operators is set."""
+        return not self.operators or (operator or '').lower() in self.operators
+
+    def prepare(self, post: Post) -> Optional[str]:
+        return None
+
+    def new_key(self, post: Post) -> str:
+        return hashlib.sha256(f"{post['link']}#{post['event_id']}".encode('utf-8')).hexdigest()[:32]
+
+    def find(self, key: str) -> Optional[Delivered]:
+        return None
+
+    @abc.abstractmethod
+    def send(self, post: Post, prepared: Optional[str], key: str) -> Delivered:
+        """Deliver a post under key, returning its reference and web URL."""
+
+    def close(self):
+        pass
+
+
+class BlueskySink(Sink):
+    """A Bluesky account. Posts get a link card with a thumbnail, updates are threaded replies."""
+
+    kind = 'bluesky'
+
+    def __init__(self, name: str, handle: Optional[str], password: Optional[str], session_file: str,
+                 http: HttpClient, image_cache: ImageCache, get_thumbnail: Callable[[str], Optional[bytes]],
+                 pds: str = 'https://bsky.social', **limits):
+        super().__init__(name, **limits)
+        self.handle = handle
+        self.password = password
+        self.session_file = session_file
+        self.http = http
+        self.image_cache = image_cache
+        self.get_thumbnail = get_thumbnail
+        self.pds = pds.rstrip('/')
+        self.client = None
+        # Serialises logins between the poster and enrichment threads
+        self.login_lock = threading.Lock()
+        # Password logins, session reuses and token refreshes since startup
+        self.login_stats = {'logins': 0, 'session_reuses': 0, 'refreshes': 0, 'login_seconds': 0.0}
+
+    def _save_session(self, event, session) -> None:
+        """Write the session string to disk whenever it is created or refreshed."""
+        from atproto import SessionEvent
+
+        if event == SessionEvent.REFRESH:
+            self.login_stats['refreshes'] += 1
+            logger.info(f"Bluesky session for {self.name} refreshed. Login stats: {self.login_stats}")
+
+        if event in (SessionEvent.CREATE, SessionEvent.REFRESH):
+            fd = os.open(self.session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.client.export_session_string())
+
+    def login(self, force: bool = False) -> None:
+        """Log in once, reusing the saved session where possible.
+
+        The client refreshes its access token by itself, so this only logs in
+        again when there is no session yet or when force is set after the
+        server rejected the current one.
+        """
+        with self.login_lock:
+            self._login(force)
+
+    def _login(self, force: bool) -> None:
+        if self.client is None:
+            from atproto import Client
+
+            if not self.handle or not self.password:
+                logger.error(f"Bluesky credentials are not set for sink {self.name}.")
+                raise ValueError(f"Missing Bluesky credentials for sink {self.name}.")
+            self.client = Client(base_url=self.http.rewrite(f'{self.pds}/xrpc'))
+            self.client.on_session_change(self._save_session)
+
+        if self.client.me is not None and not force:
+            return
+
+        start = time.perf_counter()
+        if not force and os.path.exists(self.session_file):
+            try:
+                with open(self.session_file) as f:
+                    self.client.login(session_string=f.read().strip())
+                self.login_stats['session_reuses'] += 1
+                self.login_stats['login_seconds'] += time.perf_counter() - start
+                logger.info(f"Resumed saved Bluesky session for {self.name} in {time.perf_counter() - start:.2f}s.")
+                return
+            except Exception as e:
+                logger.warning(f"Saved Bluesky session for {self.name} is no longer valid, logging in again: {e}")
+
+        start = time.perf_counter()
+        self.client.login(self.handle, self.password)
+        self.login_stats['logins'] += 1
+        self.login_stats['login_seconds'] += time.perf_counter() - start
+        logger.info(f"Logged in to Bluesky as {self.handle} in {time.perf_counter() - start:.2f}s. Login stats: {self.login_stats}")
+
+    def _call(self, function: Callable, *args, **kwargs):
+        """Call the logged in atproto client, turning its auth and rate limit errors into DeliveryErrors."""
+        from atproto_client.exceptions import RateLimitExceededError, UnauthorizedError
+
+        try:
+            return function(*args, **kwargs)
+        except RateLimitExceededError as e:
+            if e.retry_after is not None:
+                raise RateLimited(e.retry_after)
+            if e.reset_at is not None:
+                raise RateLimited(max((e.reset_at - datetime.now(timezone.utc)).total_seconds(), 0.0))
+            raise RateLimited(120)
+        except UnauthorizedError as e:
+            # The session was revoked or expired beyond refresh, log in again and retry straight away
+            logger.warning(f"Bluesky session for {self.name} rejected, logging in again: {e}")
+            self.login(force=True)
+            raise DeliveryError(f"session rejected: {e}", delay=0, counts=False)
+
+    def prepare(self, post: Post) -> Optional[str]:
+        """Upload the thumbnail to this account as a blob, reusing the blob ref cached for it."""
+        from atproto_client.models.blob_ref import BlobRef
+
+        if post['event'] != 'post' or not post['thumb_url']:
+            return None
+        blob = self.image_cache.get_blob(post['thumb_url'], account=self.handle)
+        if blob:
+            return json.dumps(blob)
+
+        img_data = self.get_thumbnail(post['thumb_url'])
+        if img_data is None:
+            return None
+        self.login()
+        thumb_blob: BlobRef = self._call(self.client.upload_blob, img_data).blob
+        blob = thumb_blob.model_dump(mode='json', by_alias=True)
+        self.image_cache.put_blob(post['thumb_url'], blob, account=self.handle)
+        return json.dumps(blob)
+
+    def new_key(self, post: Post) -> str:
+        return new_rkey()
+
+    def find(self, key: str) -> Optional[Delivered]:
+        from atproto_client.exceptions import BadRequestError
+
+        self.login()
+        try:
+            existing = self._call(self.client.app.bsky.feed.post.get, self.client.me.did, key)
+        except BadRequestError as e:
+            if getattr(e.response.content, 'error', None) != 'RecordNotFound':
+                raise
+            return None
+        return {'uri': existing.uri, 'cid': existing.cid}, self._web_url(key)
+
+    def _web_url(self, rkey: str) -> str:
+        return f"https://bsky.app/profile/{self.client.me.did}/post/{rkey}"
+
+    def send(self, post: Post, prepared: Optional[str], key: str) -> Delivered:
+        from atproto import models
+        from atproto_client.models.blob_ref import BlobRef
+
+        self.login()
+        embed = reply = None
+        if post['event'] == 'post':
+            thumb = BlobRef.model_validate(json.loads(prepared)) if prepared else None
+            # AppBskyEmbedExternal is the same as "link card" in the app
+            embed = models.AppBskyEmbedExternal.Main(external=models.AppBskyEmbedExternal.External(
+                title=post['title'], description=post['description'], uri=post['link'], thumb=thumb,
+            ))
+        elif post['root']:
+            reply = models.AppBskyFeedPost.ReplyRef(
+                root=models.ComAtprotoRepoStrongRef.Main(**post['root']),
+                parent=models.ComAtprotoRepoStrongRef.Main(**post['parent']),
+            )
+        text, facets = post['text'], post['facets'] or []
+        if len(text) > BLUESKY_LIMIT:
+            text = text[:BLUESKY_LIMIT - 1].rstrip() + '…'
+            # Facets index UTF-8 bytes from the start, keep those that end before the cut
+            kept = len(text[:-1].encode('utf-8'))
+            facets = [facet for facet in facets if facet['index']['byteEnd'] <= kept]
+        facets = [models.AppBskyRichtextFacet.Main.model_validate(facet) for facet in facets]
+        record = models.AppBskyFeedPost.Record(
+            created_at=self.client.get_current_time_iso(), text=text, embed=embed, reply=reply,
+            langs=['en'], facets=facets or None,
+        )
+        response = self._call(self.client.app.bsky.feed.post.create, self.client.me.did, record, rkey=key)
+        return {'uri': response.uri, 'cid': response.cid}, self._web_url(key)
+
+
+class _HttpSink(Sink):
+    """Shared response handling for sinks that POST JSON over the pooled HTTP client."""
+
+    def __init__(self, name: str, http: HttpClient, **limits):
+        super().__init__(name, **limits)
+        self.http = http
+
+    def _post(self, url: str, payload: dict, headers: Dict[str, str]) -> httpx.Response:
+        response = self.http.request('POST', url, json=payload, headers=headers)
+        if response.status_code == 429:
+            raise RateLimited(_retry_after(response, 120))
+        if response.status_code in (401, 403):
+            raise DeliveryError(f"{self.name} refused the credentials ({response.status_code})")
+        response.raise_for_status()
+        return response
+
+
+class MastodonSink(_HttpSink):
+    """A Mastodon-compatible account. The server builds the link card itself from the URL."""
+
+    kind = 'mastodon'
+
+    def __init__(self, name: str, base_url: str, token: str, http: HttpClient, visibility: str = 'public', **limits):
+        super().__init__(name, http, **limits)
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.visibility = visibility
+
+    def send(self, post: Post, prepared: Optional[str], key: str) -> Delivered:
+        text = post['text'].rstrip('\n')
+        suffix = f"\n{post['link']}" if post['event'] == 'post' else ''
+        if len(text) + len(suffix) > MASTODON_LIMIT:
+            text = text[:MASTODON_LIMIT - len(suffix) - 1].rstrip() + '…'
+        payload = {'status': text + suffix, 'visibility': self.visibility}
+        if post['parent']:
+            payload['in_reply_to_id'] = post['parent']['id']
+        # The server drops a repeated request with the same Idempotency-Key
+        response = self._post(f'{self.base_url}/api/v1/statuses', payload,
+                              {'Authorization': f'Bearer {self.token}', 'Idempotency-Key': key})
+        status = response.json()
+        return {'id': status['id']}, status.get('url')
+
+
+class WebhookSink(_HttpSink):
+    """A local webhook that receives each post and reply as JSON, keyed so retries can be deduplicated."""
+
+    kind = 'webhook'
+
+    def __init__(self, name: str, url: str, http: HttpClient, headers: Optional[Dict[str, str]] = None, **limits):
+        super().__init__(name, http, **limits)
+        self.url = url
+        self.headers = headers or {}
+
+    def send(self, post: Post, prepared: Optional[str], key: str) -> Delivered:
+        payload = {
+            'id': key,
+            'event': post['event'],
+            'link': post['link'],
+            'text': post['text'],
+            'title': post['title'],
+            'description': post['description'],
+            'operator': post['operator'],
+            'thumb_url': post['thumb_url'],
+        }
+        self._post(self.url, payload, {**self.headers, 'Idempotency-Key': key})
+        return {'id': key}, None
+
+
+def _resolve(value):
+    """Values written as "$NAME" are read from the environment, so secrets stay out of the file."""
+    if isinstance(value, str) and value.startswith('$'):
+        return os.getenv(value[1:])
+    if isinstance(value, dict):
+        return {key: _resolve(item) for key, item in value.items()}
+    return value
+
+
+def load_sinks(path: Optional[str], http: HttpClient, image_cache: ImageCache,
+               get_thumbnail: Callable[[str], Optional[bytes]], posts_per_minute: float, burst: int) -> List[Sink]:
+    """Build the sinks from the JSON file at path, or the single default Bluesky account without one.
+
+    Each entry has a type (bluesky, mastodon or webhook), a unique name and
+    optional operators (slugs to limit it to), posts_per_minute and burst.
+    """
+    if not path or not os.path.exists(path):
+        return [BlueskySink(DEFAULT_SINK, os.getenv('BLUESKY_HANDLE'), os.getenv('BLUESKY_PASSWORD'),
+                            os.getenv('BLUESKY_SESSION_FILE', 'bluesky_session.txt'), http, image_cache, get_thumbnail,
+                            posts_per_minute=posts_per_minute, burst=burst)]
+
+    with open(path) as f:
+        entries = json.load(f)
+
+    sinks = []
+    for entry in entries:
+        entry = {key: _resolve(value) for key, value in entry.items()}
+        name = entry['name']
+        limits = {
+            'operators': entry.get('operators'),
+            'posts_per_minute': float(entry.get('posts_per_minute', posts_per_minute)),
+            'burst': int(entry.get('burst', burst)),
+        }
+        if entry['type'] == 'bluesky':
+            sinks.append(BlueskySink(name, entry.get('handle'), entry.get('password'),
+                                     entry.get('session_file', f'bluesky_session_{name}.txt'), http, image_cache,
+                                     get_thumbnail, pds=entry.get('pds', 'https://bsky.social'), **limits))
+        elif entry['type'] == 'mastodon':
+            sinks.append(MastodonSink(name, entry['base_url'], entry['token'], http,
+                                      visibility=entry.get('visibility', 'public'), **limits))
+        elif entry['type'] == 'webhook':
+            sinks.append(WebhookSink(name, entry['url'], http, headers=entry.get('headers'), **limits))
+        else:
+            raise ValueError(f"Unknown sink type {entry['type']!r} for sink {name}")
+
+    names = [sink.name for sink in sinks]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Sink names must be unique: {names}")
+    logger.info(f"Delivering to {len(sinks)} sinks: {', '.join(f'{sink.name} ({sink.kind})' for sink in sinks)}")
+    return sinks
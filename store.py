@@ -0,0 +1,666 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from outbox import ENRICHED, FAILED, OPEN_STATES, PENDING, PREPARED, SENT
+
+logger = logging.getLogger(__name__)
+
+
+# Default location of the disruption database
+DB_PATH = 'disruptions.db'
+
+# Outbox columns that update_outbox may set
+_OUTBOX_FIELDS = ('state', 'message', 'facets', 'title', 'description', 'thumb_url', 'operator',
+                  'attempts', 'retry_at', 'last_error')
+
+# Delivery columns that update_delivery may set
+_DELIVERY_FIELDS = ('state', 'prepared', 'key', 'attempts', 'retry_at', 'last_error')
+
+# Delivery states with work left, ready to paste into a query
+_OPEN_STATES_SQL = f"({', '.join(repr(state) for state in OPEN_STATES)})"
+
+# Sink that posts made before deliveries existed belong to
+LEGACY_SINK = 'bluesky'
+
+
+def _bluesky_url(uri: str) -> str:
+    # at://<did>/app.bsky.feed.post/<rkey>
+    did, _, rkey = uri[len('at://'):].split('/')
+    return f'https://bsky.app/profile/{did}/post/{rkey}'
+
+
+class DisruptionStore:
+    """Single long-lived SQLite connection holding every scraped disruption."""
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        # The connection is shared by the main loop and any helper threads,
+        # writes are serialised through the lock below.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        # Only takes effect on a new database, older ones are converted by the first maintenance run
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.create_schema()
+
+    def create_schema(self):
+        with self.lock, self.conn:
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS disruptions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                disruption TEXT NOT NULL,
+                link TEXT NOT NULL,
+                posted INTEGER DEFAULT 0,
+                date TEXT NOT NULL
+            )
+            ''')
+            self._dedupe_links()
+            self._add_lifecycle_columns()
+            self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_disruptions_link ON disruptions(link)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_disruptions_posted ON disruptions(posted)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_disruptions_active ON disruptions(active)')
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS disruption_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                link TEXT NOT NULL,
+                event TEXT NOT NULL,
+                disruption TEXT NOT NULL,
+                at TEXT NOT NULL,
+                handled INTEGER DEFAULT 0,
+                attempts INTEGER DEFAULT 0
+            )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_disruption_events_handled ON disruption_events(handled)')
+            self._add_timestamp_columns()
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_disruptions_retention ON disruptions(active, updated_ts)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_disruption_events_retention ON disruption_events(handled, at_ts)')
+            self.conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS outbox (
+                link TEXT PRIMARY KEY,
+                state TEXT NOT NULL DEFAULT '{PENDING}',
+                message TEXT,
+                facets TEXT,
+                title TEXT,
+                description TEXT,
+                thumb_url TEXT,
+                operator TEXT,
+                attempts INTEGER DEFAULT 0,
+                retry_at INTEGER DEFAULT 0,
+                last_error TEXT,
+                updated_ts INTEGER
+            )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(state, retry_at)')
+            has_deliveries = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'deliveries'"
+            ).fetchone()
+            self.conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS deliveries (
+                link TEXT NOT NULL,
+                event_id INTEGER NOT NULL DEFAULT 0,
+                sink TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT '{PENDING}',
+                prepared TEXT,
+                key TEXT,
+                ref TEXT,
+                url TEXT,
+                attempts INTEGER DEFAULT 0,
+                retry_at INTEGER DEFAULT 0,
+                last_error TEXT,
+                updated_ts INTEGER,
+                PRIMARY KEY (link, event_id, sink)
+            )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_due ON deliveries(state, retry_at)')
+            if not has_deliveries:
+                self._migrate_to_deliveries()
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS page_metadata (
+                link TEXT PRIMARY KEY,
+                og_image TEXT,
+                title TEXT,
+                description TEXT,
+                operator TEXT,
+                fetched_at TEXT NOT NULL
+            )
+            ''')
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+            ''')
+
+    def _dedupe_links(self):
+        # Databases created before the unique index hold one copy of the page
+        # per scrape. Keep the oldest row per link, marked posted if any copy was.
+        has_index = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_disruptions_link'"
+        ).fetchone()
+        if has_index:
+            return
+
+        self.conn.execute('''
+        UPDATE disruptions SET posted = 1
+        WHERE posted = 0 AND link IN (SELECT link FROM disruptions WHERE posted = 1)
+        ''')
+        removed = self.conn.execute('''
+        DELETE FROM disruptions
+        WHERE id NOT IN (SELECT MIN(id) FROM disruptions GROUP BY link)
+        ''').rowcount
+        if removed:
+            logger.info(f"Removed {removed} duplicate disruption rows.")
+
+    def _add_lifecycle_columns(self):
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(disruptions)')}
+        if 'active' not in columns:
+            # Whether rows from before lifecycle tracking are still listed is unknown. They
+            # start inactive with no hash and are picked up silently if a scrape lists them.
+            self.conn.execute('ALTER TABLE disruptions ADD COLUMN active INTEGER DEFAULT 1')
+            self.conn.execute('UPDATE disruptions SET active = 0')
+        for column in ('content_hash', 'cleared_at', 'post_uri', 'post_cid', 'reply_uri', 'reply_cid'):
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE disruptions ADD COLUMN {column} TEXT')
+
+    def _add_timestamp_columns(self):
+        # Unix time copies of the TEXT timestamps, so retention can range scan an index
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(disruptions)')}
+        if 'updated_ts' not in columns:
+            self.conn.execute('ALTER TABLE disruptions ADD COLUMN updated_ts INTEGER')
+            self.conn.execute('''
+                UPDATE disruptions SET updated_ts = COALESCE(CAST(strftime('%s', COALESCE(cleared_at, date)) AS INTEGER), ?)
+            ''', (int(time.time()),))
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(disruption_events)')}
+        if 'at_ts' not in columns:
+            self.conn.execute('ALTER TABLE disruption_events ADD COLUMN at_ts INTEGER')
+            self.conn.execute('''
+                UPDATE disruption_events SET at_ts = COALESCE(CAST(strftime('%s', at) AS INTEGER), ?)
+            ''', (int(time.time()),))
+
+    def _migrate_to_deliveries(self):
+        # Earlier versions posted to one Bluesky account, tracked on the outbox row and the
+        # disruption. That progress becomes the deliveries of the default Bluesky sink.
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(outbox)')}
+        if 'operator' not in columns:
+            self.conn.execute('ALTER TABLE outbox ADD COLUMN operator TEXT')
+
+        deliveries = []
+        if 'rkey' in columns:
+            rows = self.conn.execute('''
+                SELECT link, state, message, blob, rkey, post_uri, post_cid, attempts, retry_at, last_error FROM outbox
+            ''').fetchall()
+            for link, state, message, blob, rkey, uri, cid, attempts, retry_at, last_error in rows:
+                if state == SENT and uri:
+                    deliveries.append((link, 0, SENT, blob, rkey, {'uri': uri, 'cid': cid}, 0, 0, None))
+                elif state == 'blob-uploaded' or (state == FAILED and message is not None):
+                    delivery_state = FAILED if state == FAILED else PREPARED if rkey else PENDING
+                    deliveries.append((link, 0, delivery_state, blob if rkey else None, rkey, None, attempts, retry_at, last_error))
+                elif state == ENRICHED:
+                    deliveries.append((link, 0, PENDING, None, None, None, 0, 0, None))
+            self.conn.execute(f'''
+                UPDATE outbox SET state = '{ENRICHED}', attempts = 0, retry_at = 0, last_error = NULL
+                WHERE state IN ('blob-uploaded', '{SENT}') OR (state = '{FAILED}' AND message IS NOT NULL)
+            ''')
+            if sqlite3.sqlite_version_info >= (3, 35):
+                for column in ('blob', 'rkey', 'post_uri', 'post_cid'):
+                    self.conn.execute(f'ALTER TABLE outbox DROP COLUMN {column}')
+
+        # Posts and the latest reply in their thread, including posts from before the outbox
+        rows = self.conn.execute('''
+            SELECT d.link, d.post_uri, d.post_cid, d.reply_uri, d.reply_cid,
+                   (SELECT MAX(e.id) FROM disruption_events e
+                    WHERE e.link = d.link AND e.event != 'appeared' AND e.handled = 1)
+            FROM disruptions d WHERE d.post_uri IS NOT NULL
+        ''').fetchall()
+        for link, post_uri, post_cid, reply_uri, reply_cid, event_id in rows:
+            deliveries.append((link, 0, SENT, None, None, {'uri': post_uri, 'cid': post_cid}, 0, 0, None))
+            if reply_uri and event_id:
+                deliveries.append((link, event_id, SENT, None, None, {'uri': reply_uri, 'cid': reply_cid}, 0, 0, None))
+
+        ts = int(time.time())
+        self.conn.executemany('''
+            INSERT OR IGNORE INTO deliveries
+                (link, event_id, sink, state, prepared, key, ref, url, attempts, retry_at, last_error, updated_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (link, event_id, LEGACY_SINK, state, prepared, key, json.dumps(ref) if ref else None,
+             _bluesky_url(ref['uri']) if ref else None, attempts, retry_at, last_error, ts)
+            for link, event_id, state, prepared, key, ref, attempts, retry_at, last_error in deliveries
+        ])
+        if deliveries:
+            logger.info(f"Moved {len(deliveries)} earlier Bluesky posts and outbox steps to the '{LEGACY_SINK}' sink.")
+
+    def get_active_hashes(self) -> Dict[str, Optional[str]]:
+        """Return {link: content hash} for every disruption currently listed."""
+        with self.lock:
+            return dict(self.conn.execute('SELECT link, content_hash FROM disruptions WHERE active = 1'))
+
+    def get_hashes(self, links: List[str]) -> Dict[str, Optional[str]]:
+        """Return {link: content hash} for the given links that are already stored."""
+        hashes = {}
+        with self.lock:
+            # Stay under SQLite's bound parameter limit
+            for start in range(0, len(links), 500):
+                chunk = links[start:start + 500]
+                hashes.update(self.conn.execute(
+                    f"SELECT link, content_hash FROM disruptions WHERE link IN ({','.join('?' * len(chunk))})", chunk
+                ))
+        return hashes
+
+    def apply_changes(self, appeared: List[Tuple[str, str, str, str]], updated: List[Tuple[str, str, str]],
+                      reopened: List[Tuple[str, str, str]], resumed: List[Tuple[str, str, str]],
+                      cleared: List[str], now: str,
+                      meta: Optional[Dict[str, Optional[str]]] = None):
+        """Write one scrape's changes and their lifecycle events in a single transaction.
+
+        appeared holds (description, link, hash, date) for new links. updated,
+        reopened and resumed hold (description, link, hash) for known links whose
+        text changed, that are listed again with the text they had when cleared,
+        and legacy rows without a hash. Resumed rows get no event. cleared holds
+        links that are no longer listed. meta values, such as the page
+        validators, are saved in the same transaction.
+        """
+        ts = int(time.time())
+        with self.lock, self.conn:
+            self.conn.executemany('''
+                INSERT INTO disruptions (disruption, link, posted, date, content_hash, active, updated_ts)
+                VALUES (?, ?, 0, ?, ?, 1, ?)
+            ''', [(description, link, date, content_hash, ts) for description, link, content_hash, date in appeared])
+            self.conn.executemany('''
+                INSERT INTO disruption_events (link, event, disruption, at, at_ts, handled) VALUES (?, 'appeared', ?, ?, ?, 1)
+            ''', [(link, description, now, ts) for description, link, _, _ in appeared])
+
+            self.conn.executemany('''
+                UPDATE disruptions SET disruption = ?, content_hash = ?, active = 1, cleared_at = NULL, updated_ts = ?
+                WHERE link = ?
+            ''', [(description, content_hash, ts, link) for description, link, content_hash in updated + reopened + resumed])
+            self.conn.executemany('''
+                INSERT INTO disruption_events (link, event, disruption, at, at_ts) VALUES (?, ?, ?, ?, ?)
+            ''', [(link, event, description, now, ts)
+                  for event, rows in (('updated', updated), ('reopened', reopened)) for description, link, _ in rows])
+            # The detail page changed with the text, drop its cached metadata
+            self.conn.executemany('DELETE FROM page_metadata WHERE link = ?', [(link,) for _, link, _ in updated])
+            # Posts no sink has started sending are enriched again from the new text. Once
+            # a delivery has its key the post may already be out and is left to finish.
+            self.conn.executemany(f'''
+                UPDATE outbox SET state = '{PENDING}', message = NULL, facets = NULL,
+                                  attempts = 0, retry_at = 0, last_error = NULL, updated_ts = ?
+                WHERE link = ? AND state IN ('{ENRICHED}', '{FAILED}')
+                  AND NOT EXISTS (SELECT 1 FROM deliveries WHERE link = outbox.link AND event_id = 0 AND key IS NOT NULL)
+            ''', [(ts, link) for _, link, _ in updated])
+            self.conn.executemany(f'''
+                DELETE FROM deliveries WHERE link = ? AND event_id = 0
+                  AND (SELECT state FROM outbox WHERE link = ?) = '{PENDING}'
+            ''', [(link, link) for _, link, _ in updated])
+            # A post given up on gets another go once its disruption is listed again
+            self.conn.executemany(f'''
+                UPDATE outbox SET state = '{PENDING}', attempts = 0, retry_at = 0, last_error = NULL, updated_ts = ?
+                WHERE link = ? AND state = '{FAILED}'
+            ''', [(ts, link) for _, link, _ in reopened + resumed])
+
+            self.conn.executemany('''
+                INSERT INTO disruption_events (link, event, disruption, at, at_ts)
+                SELECT link, 'cleared', disruption, ?, ? FROM disruptions WHERE link = ?
+            ''', [(now, ts, link) for link in cleared])
+            self.conn.executemany('''
+                UPDATE disruptions SET active = 0, cleared_at = ?, updated_ts = ? WHERE link = ?
+            ''', [(now, ts, link) for link in cleared])
+            self._write_meta(meta or {})
+
+    @staticmethod
+    def _sink_filter(sinks: Optional[List[str]]) -> str:
+        # None means every sink
+        return f"dl.sink IN ({','.join('?' * len(sinks))})" if sinks is not None else '1'
+
+    def fan_out_events(self, sinks: List[str]) -> int:
+        """Queue a reply to each unhandled lifecycle event on every sink its disruption was posted to.
+
+        An event is handled once no sink is still sending the original post.
+        Events for disruptions that were never posted have nothing to reply
+        to and are just marked handled. Returns the number of replies queued.
+        """
+        ts = int(time.time())
+        queued = 0
+        with self.lock, self.conn:
+            events = self.conn.execute('SELECT id, link FROM disruption_events WHERE handled = 0 ORDER BY id').fetchall()
+            for event_id, link in events:
+                queued += self.conn.execute(f'''
+                    INSERT OR IGNORE INTO deliveries (link, event_id, sink, updated_ts)
+                    SELECT dl.link, ?, dl.sink, ? FROM deliveries dl
+                    WHERE dl.link = ? AND dl.event_id = 0 AND dl.state = '{SENT}' AND {self._sink_filter(sinks)}
+                ''', (event_id, ts, link, *sinks)).rowcount
+                sending = self.conn.execute(f'''
+                    SELECT 1 FROM deliveries dl
+                    WHERE dl.link = ? AND dl.event_id = 0 AND dl.state IN {_OPEN_STATES_SQL}
+                      AND {self._sink_filter(sinks)}
+                ''', (link, *sinks)).fetchone()
+                if not sending:
+                    self.conn.execute('UPDATE disruption_events SET handled = 1 WHERE id = ?', (event_id,))
+        return queued
+
+    def enqueue_unposted(self) -> int:
+        """Add an outbox entry for every listed disruption that has not been posted."""
+        with self.lock, self.conn:
+            return self.conn.execute('''
+                INSERT OR IGNORE INTO outbox (link, updated_ts)
+                SELECT link, ? FROM disruptions WHERE posted = 0 AND active = 1
+            ''', (int(time.time()),)).rowcount
+
+    def get_due_outbox(self, now: float) -> List[Dict[str, Any]]:
+        """Return the outbox entries waiting to be enriched whose retry time has come, oldest disruption first."""
+        columns = ('link', 'disruption') + _OUTBOX_FIELDS
+        with self.lock:
+            rows = self.conn.execute(f'''
+                SELECT o.link, d.disruption, {', '.join('o.' + column for column in _OUTBOX_FIELDS)}
+                FROM outbox o JOIN disruptions d ON d.link = o.link
+                WHERE o.state = '{PENDING}' AND o.retry_at <= ? AND d.active = 1
+                ORDER BY d.id
+            ''', (now,)).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def update_outbox(self, link: str, **fields):
+        """Save a failed enrichment and its retry time."""
+        names = [name for name in fields if name in _OUTBOX_FIELDS]
+        if len(names) != len(fields):
+            raise ValueError(f"Unknown outbox fields: {set(fields) - set(names)}")
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"UPDATE outbox SET {', '.join(name + ' = ?' for name in names)}, updated_ts = ? WHERE link = ?",
+                (*(fields[name] for name in names), int(time.time()), link),
+            )
+
+    def save_enrichment(self, link: str, fields: Dict[str, Optional[str]], sinks: List[str]):
+        """Save an enriched post and queue its delivery to each of the given sinks in one transaction."""
+        ts = int(time.time())
+        with self.lock, self.conn:
+            self.conn.execute(f'''
+                UPDATE outbox SET state = '{ENRICHED}', message = ?, facets = ?, title = ?, description = ?,
+                                  thumb_url = ?, operator = ?, last_error = NULL, updated_ts = ?
+                WHERE link = ?
+            ''', (fields['message'], fields['facets'], fields['title'], fields['description'],
+                  fields['thumb_url'], fields['operator'], ts, link))
+            self.conn.executemany('INSERT OR IGNORE INTO deliveries (link, sink, updated_ts) VALUES (?, ?, ?)',
+                                  [(link, sink, ts) for sink in sinks])
+            self._settle(link)
+
+    def _settle(self, link: str):
+        # A disruption counts as posted once no sink is still sending it
+        self.conn.execute(f'''
+            UPDATE disruptions SET posted = 1 WHERE link = ? AND NOT EXISTS (
+                SELECT 1 FROM deliveries WHERE link = ? AND event_id = 0 AND state IN {_OPEN_STATES_SQL}
+            )
+        ''', (link, link))
+
+    def get_due_deliveries(self, now: float, sinks: Optional[List[str]] = None, link: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return the open deliveries to the given sinks, or all sinks, whose retry time has come.
+
+        Each comes with the enriched post, or for a reply its event, and
+        original posts come before replies so threads are sent in order.
+        """
+        columns = ('link', 'event_id', 'sink', 'state', 'prepared', 'key', 'attempts',
+                   'message', 'facets', 'title', 'description', 'thumb_url', 'operator', 'event', 'event_text')
+        link_filter = 'AND dl.link = ?' if link else ''
+        with self.lock:
+            rows = self.conn.execute(f'''
+                SELECT dl.link, dl.event_id, dl.sink, dl.state, dl.prepared, dl.key, dl.attempts,
+                       o.message, o.facets, o.title, o.description, o.thumb_url, o.operator, e.event, e.disruption
+                FROM deliveries dl
+                JOIN disruptions d ON d.link = dl.link
+                LEFT JOIN outbox o ON o.link = dl.link
+                LEFT JOIN disruption_events e ON e.id = dl.event_id
+                WHERE dl.state IN {_OPEN_STATES_SQL} AND dl.retry_at <= ? AND {self._sink_filter(sinks)}
+                  AND (dl.event_id != 0 OR d.active = 1) {link_filter}
+                ORDER BY dl.event_id != 0, d.id, dl.event_id
+            ''', (now, *(sinks or ()), *([link] if link else []))).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def get_thread(self, link: str, sink: str, event_id: int) -> Tuple[Optional[dict], Optional[dict]]:
+        """Return the refs of a disruption's original post on a sink and of the latest post before an event."""
+        with self.lock:
+            rows = self.conn.execute(f'''
+                SELECT event_id, ref FROM deliveries
+                WHERE link = ? AND sink = ? AND state = '{SENT}' AND event_id < ?
+                ORDER BY event_id
+            ''', (link, sink, event_id)).fetchall()
+        if not rows or rows[0][0] != 0:
+            return None, None
+        return json.loads(rows[0][1]), json.loads(rows[-1][1])
+
+    def update_delivery(self, link: str, event_id: int, sink: str, **fields):
+        """Save the result of a delivery step, or a failure and its retry time."""
+        names = [name for name in fields if name in _DELIVERY_FIELDS]
+        if len(names) != len(fields):
+            raise ValueError(f"Unknown delivery fields: {set(fields) - set(names)}")
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"UPDATE deliveries SET {', '.join(name + ' = ?' for name in names)}, updated_ts = ? "
+                f"WHERE link = ? AND event_id = ? AND sink = ?",
+                (*(fields[name] for name in names), int(time.time()), link, event_id, sink),
+            )
+            if fields.get('state') == FAILED and event_id == 0:
+                self._settle(link)
+
+    def mark_delivered(self, link: str, event_id: int, sink: str, ref: Dict[str, Any], url: Optional[str]):
+        """Record a delivered post and, once every sink is done with it, mark its disruption as posted."""
+        with self.lock, self.conn:
+            self.conn.execute(f'''
+                UPDATE deliveries SET state = '{SENT}', ref = ?, url = ?, last_error = NULL, updated_ts = ?
+                WHERE link = ? AND event_id = ? AND sink = ?
+            ''', (json.dumps(ref), url, int(time.time()), link, event_id, sink))
+            if event_id == 0:
+                self._settle(link)
+
+    def next_outbox_retry(self, sinks: Optional[List[str]] = None) -> Optional[int]:
+        """Return when the earliest open outbox entry or delivery is next due, or None if there are none."""
+        with self.lock:
+            enrich = self.conn.execute(f'''
+                SELECT MIN(o.retry_at) FROM outbox o JOIN disruptions d ON d.link = o.link
+                WHERE o.state = '{PENDING}' AND d.active = 1
+            ''').fetchone()[0]
+            deliver = self.conn.execute(f'''
+                SELECT MIN(dl.retry_at) FROM deliveries dl JOIN disruptions d ON d.link = dl.link
+                WHERE dl.state IN {_OPEN_STATES_SQL} AND {self._sink_filter(sinks)}
+                  AND (dl.event_id != 0 OR d.active = 1)
+            ''', sinks or ()).fetchone()[0]
+        due = [retry_at for retry_at in (enrich, deliver) if retry_at is not None]
+        return min(due) if due else None
+
+    def outbox_counts(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.conn.execute('SELECT state, COUNT(*) FROM outbox GROUP BY state'))
+
+    def delivery_counts(self) -> Dict[Tuple[str, str], int]:
+        """Return {(sink, state): count} over every delivery."""
+        with self.lock:
+            rows = self.conn.execute('SELECT sink, state, COUNT(*) FROM deliveries GROUP BY sink, state').fetchall()
+        return {(sink, state): count for sink, state, count in rows}
+
+    def get_unposted_disruptions(self) -> List[Tuple[str, str]]:
+        with self.lock:
+            return self.conn.execute(
+                'SELECT disruption, link FROM disruptions WHERE posted = 0 AND active = 1 ORDER BY id'
+            ).fetchall()
+
+    def get_active_disruptions(self) -> List[Dict[str, Any]]:
+        """Return every listed disruption with its operator once known, most recently changed first."""
+        columns = ('link', 'disruption', 'date', 'updated_ts', 'operator')
+        with self.lock:
+            rows = self.conn.execute('''
+                SELECT d.link, d.disruption, d.date, d.updated_ts, COALESCE(o.operator, p.operator)
+                FROM disruptions d
+                LEFT JOIN outbox o ON o.link = d.link
+                LEFT JOIN page_metadata p ON p.link = d.link
+                WHERE d.active = 1
+                ORDER BY d.updated_ts DESC, d.id DESC
+            ''').fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def get_page_metadata(self, link: str) -> Optional[Dict[str, Optional[str]]]:
+        with self.lock:
+            row = self.conn.execute('''
+                SELECT og_image, title, description, operator FROM page_metadata WHERE link = ?
+            ''', (link,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('og_image', 'title', 'description', 'operator'), row))
+
+    def set_page_metadata(self, link: str, metadata: Dict[str, Optional[str]], fetched_at: str):
+        with self.lock, self.conn:
+            self.conn.execute('''
+                INSERT OR REPLACE INTO page_metadata (link, og_image, title, description, operator, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (link, metadata['og_image'], metadata['title'], metadata['description'], metadata['operator'], fetched_at))
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: Optional[str]):
+        self.set_metas({key: value})
+
+    def set_metas(self, values: Dict[str, Optional[str]]):
+        """Save several meta values in one transaction."""
+        with self.lock, self.conn:
+            self._write_meta(values)
+
+    def _write_meta(self, values: Dict[str, Optional[str]]):
+        self.conn.executemany('''
+            INSERT INTO meta (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', list(values.items()))
+
+    def archive_inactive(self, cutoff_ts: int, archive_path: Optional[str]) -> Tuple[int, int]:
+        """Move disruptions no longer listed and handled events older than cutoff_ts out of the hot tables.
+
+        Rows are copied into the same tables in the archive database at
+        archive_path first, or just deleted when it is empty. Returns the
+        number of disruptions and events moved.
+        """
+        with self.lock:
+            if archive_path:
+                self.conn.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+            try:
+                with self.conn:
+                    if archive_path:
+                        self._create_archive_schema()
+                        # Copy before deleting, a crash in between only repeats the copy next run
+                        self.conn.execute('''
+                            INSERT OR REPLACE INTO archive.disruptions
+                            SELECT id, disruption, link, posted, date, content_hash, cleared_at,
+                                   post_uri, post_cid, reply_uri, reply_cid, updated_ts, ?
+                            FROM disruptions WHERE active = 0 AND updated_ts < ?
+                        ''', (int(time.time()), cutoff_ts))
+                        self.conn.execute('''
+                            INSERT OR REPLACE INTO archive.disruption_events
+                            SELECT id, link, event, disruption, at, at_ts, attempts
+                            FROM disruption_events WHERE handled = 1 AND at_ts < ?
+                        ''', (cutoff_ts,))
+                        # Where each post ended up on every sink
+                        self.conn.execute('''
+                            INSERT OR REPLACE INTO archive.deliveries
+                            SELECT link, event_id, sink, state, ref, url, updated_ts FROM deliveries
+                            WHERE link IN (SELECT link FROM disruptions WHERE active = 0 AND updated_ts < ?)
+                        ''', (cutoff_ts,))
+                    disruptions = self.conn.execute(
+                        'DELETE FROM disruptions WHERE active = 0 AND updated_ts < ?', (cutoff_ts,)
+                    ).rowcount
+                    events = self.conn.execute(
+                        'DELETE FROM disruption_events WHERE handled = 1 AND at_ts < ?', (cutoff_ts,)
+                    ).rowcount
+                    # Cached detail pages are only needed while their disruption is in the hot table
+                    self.conn.execute('DELETE FROM page_metadata WHERE link NOT IN (SELECT link FROM disruptions)')
+                    self.conn.execute('DELETE FROM outbox WHERE link NOT IN (SELECT link FROM disruptions)')
+                    self.conn.execute('DELETE FROM deliveries WHERE link NOT IN (SELECT link FROM disruptions)')
+            finally:
+                if archive_path:
+                    self.conn.execute('DETACH DATABASE archive')
+        return disruptions, events
+
+    def _create_archive_schema(self):
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.disruptions (
+            id INTEGER PRIMARY KEY,
+            disruption TEXT NOT NULL,
+            link TEXT NOT NULL,
+            posted INTEGER,
+            date TEXT NOT NULL,
+            content_hash TEXT,
+            cleared_at TEXT,
+            post_uri TEXT,
+            post_cid TEXT,
+            reply_uri TEXT,
+            reply_cid TEXT,
+            updated_ts INTEGER,
+            archived_ts INTEGER
+        )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_disruptions_link ON disruptions(link)')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.disruption_events (
+            id INTEGER PRIMARY KEY,
+            link TEXT NOT NULL,
+            event TEXT NOT NULL,
+            disruption TEXT NOT NULL,
+            at TEXT NOT NULL,
+            at_ts INTEGER,
+            attempts INTEGER
+        )
+        ''')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.deliveries (
+            link TEXT NOT NULL,
+            event_id INTEGER NOT NULL,
+            sink TEXT NOT NULL,
+            state TEXT,
+            ref TEXT,
+            url TEXT,
+            updated_ts INTEGER,
+            PRIMARY KEY (link, event_id, sink)
+        )
+        ''')
+
+    def size_stats(self) -> Dict[str, int]:
+        """Database file sizes in bytes and the number of free pages inside the main file."""
+        with self.lock:
+            page_size = self.conn.execute('PRAGMA page_size').fetchone()[0]
+            page_count = self.conn.execute('PRAGMA page_count').fetchone()[0]
+            freelist = self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+            rows = self.conn.execute('SELECT COUNT(*) FROM disruptions').fetchone()[0]
+        wal_path = self.path + '-wal'
+        return {
+            'bytes': page_size * page_count,
+            'free_bytes': page_size * freelist,
+            'wal_bytes': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+            'disruptions': rows,
+        }
+
+    def compact(self, max_pages: Optional[int] = None) -> bool:
+        """Give free pages back to the filesystem and refresh the query planner statistics.
+
+        Databases created before auto_vacuum was enabled get one full VACUUM to
+        switch them over, later runs only free pages incrementally. Returns
+        True when that full VACUUM ran.
+        """
+        with self.lock:
+            converted = False
+            if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                self.conn.execute('VACUUM')
+                converted = True
+            else:
+                pages = f'({max_pages})' if max_pages else ''
+                self.conn.execute(f'PRAGMA incremental_vacuum{pages}').fetchall()
+            self.conn.execute('ANALYZE')
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return converted
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
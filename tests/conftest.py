@@ -0,0 +1,75 @@
+import os
+import sys
+
+import pytest
+
+# The bot is a set of flat modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lifecycle import DisruptionTracker  # noqa: E402
+from sinks import Sink  # noqa: E402
+from store import DisruptionStore  # noqa: E402
+
+LINK = 'https://www.nationalrail.co.uk/service-disruptions/test-1/'
+NOW = '2024-01-01 08:00:00'
+
+
+class FakeSink(Sink):
+    """A sink that keeps what it was sent in memory and can lose the response to a send."""
+
+    kind = 'fake'
+
+    def __init__(self, name: str = 'fake', store: DisruptionStore = None):
+        super().__init__(name, posts_per_minute=6000, burst=100)
+        self.store = store
+        self.sent = {}
+        self.sends = 0
+        self.lose_responses = 0
+        self.fail_sends = 0
+        self.state_at_send = []
+
+    def prepare(self, post):
+        return f"blob for {post['link']}" if post['event'] == 'post' else None
+
+    def find(self, key):
+        return ({'id': key}, f'https://fake.example/{key}') if key in self.sent else None
+
+    def send(self, post, prepared, key):
+        if self.store is not None:
+            # What the database held when the post went out
+            self.state_at_send.append(self.store.conn.execute(
+                'SELECT state, key FROM deliveries WHERE link = ? AND event_id = ? AND sink = ?',
+                (post['link'], post['event_id'], self.name),
+            ).fetchone())
+        if self.fail_sends:
+            self.fail_sends -= 1
+            raise ConnectionError('server unavailable')
+        self.sends += 1
+        self.sent[key] = post
+        if self.lose_responses:
+            self.lose_responses -= 1
+            raise TimeoutError('response lost after the post was made')
+        return {'id': key}, f'https://fake.example/{key}'
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = DisruptionStore(str(tmp_path / 'disruptions.db'))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def tracker(store):
+    return DisruptionTracker(store)
+
+
+@pytest.fixture
+def bot(store, monkeypatch):
+    """natrail wired to the temporary database and one fake sink."""
+    import natrail
+
+    sink = FakeSink(store=store)
+    monkeypatch.setattr(natrail, 'store', store)
+    monkeypatch.setattr(natrail, 'sinks', [sink])
+    return natrail, sink
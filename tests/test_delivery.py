@@ -0,0 +1,168 @@
+import time
+
+import outbox
+from conftest import LINK, NOW
+from outbox import ENRICHED, FAILED, PENDING, PREPARED, SENT, new_rkey
+
+TEXT = 'Disruption between Hull and Leeds. Trains may be delayed.'
+
+
+def _list(tracker, text=TEXT):
+    return tracker.apply([(text, LINK, NOW)], NOW)
+
+
+def _enrich(store, sinks=('fake',)):
+    store.enqueue_unposted()
+    store.save_enrichment(LINK, {
+        'message': f'{TEXT}\n', 'facets': '[]', 'title': 'National Rail Disruptions', 'description': TEXT,
+        'thumb_url': None, 'operator': 'northern',
+    }, list(sinks))
+
+
+def _due(store):
+    # Ignore backoff, every open delivery is due
+    return store.get_due_deliveries(time.time() + 10 ** 6)
+
+
+def _delivery(store, event_id=0):
+    return store.conn.execute(
+        "SELECT state, key, attempts FROM deliveries WHERE link = ? AND event_id = ? AND sink = 'fake'",
+        (LINK, event_id),
+    ).fetchone()
+
+
+def _posted(store):
+    return store.conn.execute('SELECT posted FROM disruptions WHERE link = ?', (LINK,)).fetchone()[0]
+
+
+def test_post_moves_from_outbox_to_sent(bot, store, tracker):
+    natrail, sink = bot
+    _list(tracker)
+    assert store.enqueue_unposted() == 1
+    assert [entry['link'] for entry in store.get_due_outbox(time.time())] == [LINK]
+
+    _enrich(store)
+    assert store.outbox_counts() == {ENRICHED: 1}
+    assert _delivery(store) == (PENDING, None, 0)
+    assert _posted(store) == 0
+
+    natrail.send_delivery(sink, _due(store)[0])
+    state, key, _ = _delivery(store)
+    assert state == SENT
+    # The key was saved, with the upload, before anything was sent
+    assert sink.state_at_send == [(PREPARED, key)]
+    assert store.conn.execute('SELECT prepared FROM deliveries WHERE link = ?', (LINK,)).fetchone()[0] == f'blob for {LINK}'
+    assert _posted(store) == 1
+    assert _due(store) == []
+
+
+def test_lost_response_is_found_instead_of_posted_again(bot, store, tracker):
+    natrail, sink = bot
+    _list(tracker)
+    _enrich(store)
+    sink.lose_responses = 1
+
+    assert natrail.deliver(sink, _due(store)[0]) is False
+    state, key, attempts = _delivery(store)
+    assert (state, attempts) == (PREPARED, 1) and key in sink.sent
+    assert _posted(store) == 0
+
+    assert natrail.deliver(sink, _due(store)[0]) is True
+    assert sink.sends == 1
+    assert _delivery(store)[0] == SENT
+    assert _posted(store) == 1
+
+
+def test_failed_delivery_is_given_up_after_its_attempts(bot, store, tracker, monkeypatch):
+    natrail, sink = bot
+    monkeypatch.setattr(natrail, 'OUTBOX_MAX_ATTEMPTS', 2)
+    _list(tracker)
+    _enrich(store)
+    sink.fail_sends = 5
+
+    for _ in range(2):
+        assert natrail.deliver(sink, _due(store)[0]) is False
+    assert _delivery(store)[0::2] == (FAILED, 2)
+    assert sink.sends == 0
+    assert _due(store) == []
+    # Nothing is still sending it, so it is not picked up as unposted again
+    assert _posted(store) == 1
+
+
+def test_text_change_enriches_an_unsent_post_again(bot, store, tracker):
+    _list(tracker)
+    _enrich(store)
+
+    assert _list(tracker, TEXT + ' Updated.')['updated'] == 1
+    assert store.conn.execute('SELECT state, message FROM outbox').fetchone() == (PENDING, None)
+    assert _delivery(store) is None
+    assert [entry['link'] for entry in store.get_due_outbox(time.time())] == [LINK]
+
+
+def test_text_change_leaves_a_post_that_may_be_out(bot, store, tracker):
+    natrail, sink = bot
+    _list(tracker)
+    _enrich(store)
+    sink.lose_responses = 1
+    natrail.deliver(sink, _due(store)[0])
+    key = _delivery(store)[1]
+
+    _list(tracker, TEXT + ' Updated.')
+    assert store.outbox_counts() == {ENRICHED: 1}
+    assert _delivery(store)[:2] == (PREPARED, key)
+
+    natrail.deliver(sink, _due(store)[0])
+    assert sink.sends == 1
+
+
+def test_failed_post_is_retried_once_listed_again(bot, store, tracker):
+    _list(tracker)
+    store.enqueue_unposted()
+    store.update_outbox(LINK, state=FAILED, attempts=5, last_error='flickr down')
+
+    tracker.apply([], NOW)
+    tracker.apply([('Another disruption.', LINK + 'other/', NOW)], NOW)
+    assert _list(tracker)['reopened'] == 1
+    assert store.conn.execute('SELECT state, attempts, last_error FROM outbox WHERE link = ?', (LINK,)).fetchone() == (PENDING, 0, None)
+
+
+def test_update_and_relisting_are_replied_to_in_the_thread(bot, store, tracker):
+    natrail, sink = bot
+    _list(tracker)
+    _enrich(store)
+    natrail.send_delivery(sink, _due(store)[0])
+    root = {'id': _delivery(store)[1]}
+
+    _list(tracker, TEXT + ' Updated.')
+    assert store.fan_out_events(['fake']) == 1
+    reply = _due(store)[0]
+    assert reply['event'] == 'updated'
+    post = natrail.build_post(sink, reply)
+    assert post['root'] == post['parent'] == root
+    natrail.send_delivery(sink, reply)
+
+    # Cleared, then listed again with the same text
+    tracker.apply([('Another disruption.', LINK + 'other/', NOW)], NOW)
+    _list(tracker, TEXT + ' Updated.')
+    assert store.fan_out_events(['fake']) == 2
+    events = [delivery['event'] for delivery in _due(store)]
+    assert events == ['cleared', 'reopened']
+    for delivery in _due(store):
+        natrail.send_delivery(sink, delivery)
+    assert sink.sends == 4
+    assert store.conn.execute('SELECT COUNT(*) FROM disruption_events WHERE handled = 0').fetchone()[0] == 0
+
+
+def test_record_keys_are_tids_in_creation_order(monkeypatch):
+    keys = [new_rkey() for _ in range(1000)]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+    for key in keys:
+        assert len(key) == 13 and set(key) <= set(outbox._TID_ALPHABET)
+        # The top bit of a TID is always zero
+        assert key[0] in '234567abcdefghij'
+
+    # Still increasing when the clock stands still or goes back
+    monkeypatch.setattr(outbox.time, 'time', lambda: 1_000_000_000.0)
+    later = [new_rkey() for _ in range(3)]
+    assert keys[-1] < later[0] < later[1] < later[2]
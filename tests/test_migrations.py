@@ -0,0 +1,112 @@
+import sqlite3
+
+import pytest
+
+from conftest import NOW
+from lifecycle import DisruptionTracker
+from outbox import ENRICHED, PENDING, PREPARED, SENT
+from store import LEGACY_SINK, DisruptionStore
+
+LINKS = [f'https://www.nationalrail.co.uk/service-disruptions/test-{i}/' for i in range(4)]
+
+
+def test_baseline_database_with_duplicate_rows(tmp_path):
+    path = str(tmp_path / 'disruptions.db')
+    # The table as the first version created it, with one row per scrape
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE disruptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            disruption TEXT NOT NULL,
+            link TEXT NOT NULL,
+            posted INTEGER DEFAULT 0,
+            date TEXT NOT NULL
+        )
+    ''')
+    conn.executemany('INSERT INTO disruptions (disruption, link, posted, date) VALUES (?, ?, ?, ?)', [
+        ('Disruption A.', LINKS[0], 0, '2023-01-01 08:00:00'),
+        ('Disruption A.', LINKS[0], 1, '2023-01-01 08:05:00'),
+        ('Disruption B.', LINKS[1], 0, '2023-01-01 08:00:00'),
+        ('Disruption B.', LINKS[1], 0, '2023-01-01 08:05:00'),
+    ])
+    conn.commit()
+    conn.close()
+
+    store = DisruptionStore(path)
+    rows = store.conn.execute('SELECT id, link, posted, active, content_hash FROM disruptions ORDER BY id').fetchall()
+    # The oldest copy is kept, posted if any copy was
+    assert rows == [(1, LINKS[0], 1, 0, None), (3, LINKS[1], 0, 0, None)]
+    with pytest.raises(sqlite3.IntegrityError):
+        store.conn.execute("INSERT INTO disruptions (disruption, link, date) VALUES ('x', ?, 'x')", (LINKS[0],))
+    store.close()
+
+    # Opening it again changes nothing
+    store = DisruptionStore(path)
+    assert store.conn.execute('SELECT id, posted FROM disruptions ORDER BY id').fetchall() == [(1, 1), (3, 0)]
+
+    # Listed rows are picked up silently, and only the unposted one is queued
+    tracker = DisruptionTracker(store)
+    changes = tracker.apply([('Disruption A.', LINKS[0], NOW), ('Disruption B.', LINKS[1], NOW)], NOW)
+    assert changes == {'appeared': 0, 'updated': 0, 'reopened': 0, 'resumed': 2, 'cleared': 0}
+    assert store.conn.execute('SELECT COUNT(*) FROM disruption_events').fetchone()[0] == 0
+    assert store.enqueue_unposted() == 1
+    assert store.conn.execute('SELECT link FROM outbox').fetchall() == [(LINKS[1],)]
+    store.close()
+
+
+def test_outbox_steps_move_to_deliveries(tmp_path):
+    path = str(tmp_path / 'disruptions.db')
+    store = DisruptionStore(path)
+    DisruptionTracker(store).apply([(f'Disruption {i}.', link, NOW) for i, link in enumerate(LINKS)], NOW)
+    # Back to the single-account outbox, which tracked each step on its own row
+    store.conn.executescript('''
+        DROP TABLE deliveries;
+        DROP TABLE outbox;
+        CREATE TABLE outbox (
+            link TEXT PRIMARY KEY,
+            state TEXT NOT NULL DEFAULT 'pending',
+            message TEXT,
+            facets TEXT,
+            title TEXT,
+            description TEXT,
+            thumb_url TEXT,
+            blob TEXT,
+            rkey TEXT,
+            post_uri TEXT,
+            post_cid TEXT,
+            attempts INTEGER DEFAULT 0,
+            retry_at INTEGER DEFAULT 0,
+            last_error TEXT,
+            updated_ts INTEGER
+        );
+    ''')
+    store.conn.executemany('''
+        INSERT INTO outbox (link, state, message, blob, rkey, post_uri, post_cid, attempts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (LINKS[0], 'sent', 'm0', 'b0', 'r0', 'at://did:plc:abc/app.bsky.feed.post/r0', 'c0', 0),
+        (LINKS[1], 'blob-uploaded', 'm1', 'b1', 'r1', None, None, 2),
+        (LINKS[2], 'blob-uploaded', 'm2', 'b2', None, None, None, 1),
+        (LINKS[3], 'enriched', 'm3', None, None, None, None, 0),
+    ])
+    store.conn.commit()
+    store.close()
+
+    store = DisruptionStore(path)
+    deliveries = {row[0]: row[1:] for row in store.conn.execute(
+        'SELECT link, state, prepared, key, url, attempts FROM deliveries WHERE event_id = 0 AND sink = ?', (LEGACY_SINK,)
+    )}
+    assert deliveries == {
+        LINKS[0]: (SENT, 'b0', 'r0', 'https://bsky.app/profile/did:plc:abc/post/r0', 0),
+        # A post with its key may be out already, it resumes at find()
+        LINKS[1]: (PREPARED, 'b1', 'r1', None, 2),
+        LINKS[2]: (PENDING, None, None, None, 1),
+        LINKS[3]: (PENDING, None, None, None, 0),
+    }
+    assert store.outbox_counts() == {ENRICHED: 4}
+    assert store.get_thread(LINKS[0], LEGACY_SINK, 1)[0] == {'uri': 'at://did:plc:abc/app.bsky.feed.post/r0', 'cid': 'c0'}
+    store.close()
+
+    # Opening it again does not migrate twice
+    store = DisruptionStore(path)
+    assert store.conn.execute('SELECT COUNT(*) FROM deliveries').fetchone()[0] == 4
+    store.close()
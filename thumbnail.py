@@ -0,0 +1,92 @@
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from http_client import HttpClient
+
+logger = logging.getLogger(__name__)
+
+
+# Downloads are abandoned once they pass this many bytes
+MAX_DOWNLOAD_BYTES = 5 * 1024 * 1024
+
+# Bluesky rejects blobs over 1,000,000 bytes, thumbnails aim well below that
+BLOB_LIMIT = 1_000_000
+TARGET_BYTES = 300_000
+
+# Longest edge of a link card thumbnail in pixels
+MAX_DIMENSION = 800
+
+# JPEG qualities tried in turn until the thumbnail fits TARGET_BYTES
+_QUALITIES = (85, 75, 65, 50)
+
+# Decoding and re-encoding happen here. Two workers cap how many full-size
+# images are held decoded at once, however many enrichment threads ask.
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='thumbnail')
+
+
+def _has_pillow() -> bool:
+    try:
+        import PIL  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def download(http: HttpClient, url: str, max_bytes: int = MAX_DOWNLOAD_BYTES) -> Optional[bytes]:
+    """Stream an image into memory, giving up with None once it passes max_bytes."""
+    with http.stream('GET', url) as response:
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            logger.warning(f"Skipping image {url}: {length} bytes is over the {max_bytes} byte cap")
+            return None
+
+        data = bytearray()
+        for chunk in response.iter_bytes():
+            data += chunk
+            if len(data) > max_bytes:
+                logger.warning(f"Skipping image {url}: over the {max_bytes} byte cap")
+                return None
+    return bytes(data)
+
+
+def _shrink(data: bytes, max_dimension: int, target_bytes: int) -> Optional[bytes]:
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        if image.format == 'JPEG' and max(image.size) <= max_dimension and len(data) <= target_bytes:
+            return data
+
+        # Let the JPEG decoder scale down by a power of two while decoding
+        image.draft('RGB', (max_dimension, max_dimension))
+        image = image.convert('RGB')
+        image.thumbnail((max_dimension, max_dimension))
+
+        while True:
+            for quality in _QUALITIES:
+                out = io.BytesIO()
+                image.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+                if out.tell() <= target_bytes:
+                    return out.getvalue()
+            if max(image.size) <= 200:
+                break
+            image.thumbnail((max(image.size) * 3 // 4,) * 2)
+
+    return out.getvalue() if out.tell() <= BLOB_LIMIT else None
+
+
+def make_thumbnail(data: bytes, max_dimension: int = MAX_DIMENSION, target_bytes: int = TARGET_BYTES) -> Optional[bytes]:
+    """Downscale and recompress an image to a JPEG of at most target_bytes, in a worker thread.
+
+    Without Pillow the image is passed through as long as Bluesky would
+    accept it. Returns None when the image cannot be used.
+    """
+    if not _has_pillow():
+        return data if len(data) <= BLOB_LIMIT else None
+    try:
+        return _executor.submit(_shrink, data, max_dimension, target_bytes).result()
+    except Exception as e:
+        logger.warning(f"Could not make a thumbnail: {e}")
+        return None